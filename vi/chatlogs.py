@@ -0,0 +1,656 @@
+###########################################################################
+#  Vintel - Visual Intel Chat Analyzer                                    #
+#  Copyright (C) 2014-15 Sebastian Meyer (sparrow.242.de+eve@gmail.com )  #
+#                                                                         #
+#  This program is free software: you can redistribute it and/or modify   #
+#  it under the terms of the GNU General Public License as published by   #
+#  the Free Software Foundation, either version 3 of the License, or      #
+#  (at your option) any later version.                                    #
+#                                                                         #
+#  This program is distributed in the hope that it will be useful,        #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#  GNU General Public License for more details.                           #
+#                                                                         #
+#                                                                         #
+#  You should have received a copy of the GNU General Public License      #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+###########################################################################
+# Working with the chatlogs EVE writes on disk. No Qt in here!            #
+###########################################################################
+
+import calendar
+import codecs
+import ctypes
+import ctypes.util
+import logging
+import os
+import re
+import select
+import struct
+import sys
+import threading
+import time
+
+# EVE writes the chatlogs in UTF-16 (little endian) with a BOM
+LOG_ENCODING = "utf-16-le"
+BOM = u"\ufeff"
+
+# the header of a chatlog (channel, listener, session started) has about
+# 1 KB, we never read more than this to get it
+HEADER_SIZE = 4096
+
+# Names the local chatlogs could start with (depends on l10n of the client)
+LOCAL_NAMES = ("Lokal", "Local")
+
+# EVE names the file like room_20140913_200737.txt
+FILENAME_REGEX = re.compile(r'^(.+)_(\d{8})_(\d{6})' + re.escape(os.path.extsep) + 'txt$', re.IGNORECASE)
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+
+def parse_filename(filename):
+    """ Returns a tuple (roomname, started) for the name of a chatlog, where
+        started is the time from the filename in seconds since the epoch.
+        Returns None if filename is not the name of a chatlog."""
+    match = FILENAME_REGEX.match(filename)
+    if not match:
+        return None
+    roomname, day, clock = match.groups()
+    started = calendar.timegm((int(day[:4]), int(day[4:6]), int(day[6:]),
+                               int(clock[:2]), int(clock[2:4]), int(clock[4:]), 0, 0, 0))
+    return roomname, started
+
+
+def find_chatlog_dir(path=None):
+    """ Returns the directory with the chatlogs: path if it exists, else the
+        first existing of the places the EVE client uses on linux (wine),
+        mac and windows. None if there is none."""
+    candidates = []
+    if path:
+        candidates.append(path)
+    home = os.path.expanduser("~")
+    candidates.append(os.path.join(home, "EVE", "logs", "Chatlogs"))
+    candidates.append(os.path.join(home, "Library", "Application Support", "Eve Online", "p_drive", "User",
+                                   "My Documents", "EVE", "logs", "Chatlogs"))
+    if os.name == "nt":
+        CSIDL_PERSONAL = 5
+        SHGFP_TYPE_CURRENT = 0
+        buf = ctypes.create_unicode_buffer(260)
+        ctypes.windll.shell32.SHGetFolderPathW(0, CSIDL_PERSONAL, 0, SHGFP_TYPE_CURRENT, buf)
+        candidates.append(os.path.join(buf.value, "EVE", "logs", "Chatlogs"))
+    for candidate in candidates:
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+
+def read_header(path, size=HEADER_SIZE):
+    """ Returns the lines of the header of the chatlog at path, that are all
+        lines before the first message. Reads only the first size bytes of
+        the file, no matter how big it is."""
+    with open(path, "rb") as f:
+        data = f.read(size)
+    text = data[:len(data) - len(data) % 2].decode(LOG_ENCODING, "replace")
+    if text.startswith(BOM):
+        text = text[1:]
+    lines = text.split(u"\n")
+    if len(data) == size:
+        # the last line may be cut
+        lines.pop()
+    header = []
+    for line in lines:
+        line = line.rstrip(u"\r")
+        # EVE starts the lines with a BOM sometimes
+        if line.strip().lstrip(BOM).startswith(u"["):
+            break
+        header.append(line)
+    return header
+
+
+def read_lines_since(path, since, end=None, block_size=64*1024):
+    """ Returns the messages of the chatlog at path with a timestamp of
+        since or later, since is a string like in the logs
+        (2015.02.12 18:03:21), so we can compare without parsing.
+        We read the file backwards in blocks from end (default: the end of
+        the file) until we find an older message, so a big log costs not
+        more than the lines we need."""
+    blocks = []
+    with open(path, "rb") as f:
+        if end is None:
+            f.seek(0, os.SEEK_END)
+            end = f.tell()
+        position = end - end % 2
+        while position > 0:
+            start = max(0, position - block_size)
+            start -= start % 2
+            f.seek(start)
+            block = f.read(position - start)
+            blocks.insert(0, block)
+            position = start
+            # a complete line in the block older than since? so we have all
+            lines = block.decode(LOG_ENCODING, "replace").split(u"\n")
+            if start > 0:
+                lines = lines[1:]
+            timestamps = (_timestamp_of(line) for line in lines[:-1])
+            if any(timestamp is not None and timestamp < since for timestamp in timestamps):
+                break
+    text = b"".join(blocks).decode(LOG_ENCODING, "replace")
+    lines = text.split(u"\n")
+    if position > 0:
+        # we started in the middle of a line
+        lines = lines[1:]
+    # the last one is not terminated (yet)
+    lines.pop()
+    result = []
+    for line in lines:
+        line = line.strip().lstrip(BOM)
+        timestamp = _timestamp_of(line)
+        if timestamp is not None and timestamp >= since:
+            result.append(line)
+    return result
+
+
+def _timestamp_of(line):
+    """ Returns the timestamp of a message as string, None if no message"""
+    line = line.strip().lstrip(BOM)
+    if not line.startswith(u"["):
+        return None
+    return line[1:line.find(u"]")].strip()
+
+
+class ChatlogIndex(object):
+    """ Index of the recent chatlogs in the directory, shared by the
+        FileWatcher and the ChatParser.
+        The directory is read with os.scandir. A file is only stat'ed when
+        it is seen the first time and its name does not tell us already
+        that it is too old. Files we don't need are remembered by name, so
+        a rescan of a directory with thousands of old logs costs no
+        stat at all."""
+
+    # EVE has a downtime every day, so nobody writes into a log started
+    # two days ago (one day + slack for the timezone of the filename)
+    SESSION_SLACK = 60*60*24*2
+
+    # on windows the stat of a DirEntry comes with the directory listing
+    STAT_IS_FREE = (os.name == "nt")
+
+    def __init__(self, path, max_age):
+        """ path = the directory with the chatlogs
+            max_age = only files modified in the last max_age seconds"""
+        self.path = path
+        self.max_age = max_age
+        self.entries = {}       # full path: {"roomname", "started", "mtime", "size"}
+        self._skipped = set()   # filenames we don't need to look at again
+        self._lock = threading.Lock()
+
+    def paths(self):
+        with self._lock:
+            return list(self.entries)
+
+    def roomname(self, path):
+        entry = self.entries.get(path)
+        if entry:
+            return entry["roomname"]
+        parsed = parse_filename(os.path.basename(path))
+        return parsed[0] if parsed else None
+
+    def refresh(self):
+        """ Rescans the directory. Returns a tuple of lists (added, removed,
+            changed) with the full pathes. changed is only filled if the
+            stat is free (windows), with the known files which have a new
+            size"""
+        now = time.time()
+        added = []
+        changed = []
+        seen = set()
+        seen_skipped = set()
+        with self._lock:
+            with os.scandir(self.path) as dir_entries:
+                for dir_entry in dir_entries:
+                    name = dir_entry.name
+                    if name in self._skipped:
+                        seen_skipped.add(name)
+                        continue
+                    full_path = dir_entry.path
+                    seen.add(full_path)
+                    entry = self.entries.get(full_path)
+                    if entry is None:
+                        if self._add(name, full_path, dir_entry, now):
+                            added.append(full_path)
+                        elif name in self._skipped:
+                            seen_skipped.add(name)
+                    elif self.STAT_IS_FREE:
+                        try:
+                            stat = dir_entry.stat()
+                        except OSError:
+                            continue
+                        if stat.st_size != entry["size"]:
+                            entry["size"] = stat.st_size
+                            entry["mtime"] = stat.st_mtime
+                            changed.append(full_path)
+            removed = [full_path for full_path, entry in self.entries.items()
+                       if full_path not in seen or (self.max_age and now - entry["mtime"] > self.max_age)]
+            for full_path in removed:
+                del self.entries[full_path]
+            # forget the names of files which are deleted
+            self._skipped = seen_skipped
+        return added, removed, changed
+
+    def add(self, filename):
+        """ Adds a new file (f.e. after an inotify event). Returns the full
+            path if the file is a chatlog we must watch, else None"""
+        full_path = os.path.join(self.path, filename)
+        with self._lock:
+            if full_path in self.entries:
+                return None
+            if self._add(filename, full_path, None, time.time()):
+                return full_path
+        return None
+
+    def remove(self, filename):
+        """ Removes a deleted file. Returns the full path if the file was in
+            the index, else None"""
+        full_path = os.path.join(self.path, filename)
+        with self._lock:
+            self._skipped.discard(filename)
+            if self.entries.pop(full_path, None) is not None:
+                return full_path
+        return None
+
+    def touch(self, path, size):
+        """ The file got new content"""
+        entry = self.entries.get(path)
+        if entry:
+            entry["size"] = size
+            entry["mtime"] = time.time()
+
+    def _add(self, filename, full_path, dir_entry, now):
+        parsed = parse_filename(filename)
+        if parsed is None:
+            self._skipped.add(filename)
+            return False
+        roomname, started = parsed
+        if self.max_age and now - started > self.max_age + self.SESSION_SLACK:
+            # too old, and we know this without a stat
+            self._skipped.add(filename)
+            return False
+        try:
+            if dir_entry is not None:
+                if not dir_entry.is_file():
+                    self._skipped.add(filename)
+                    return False
+                stat = dir_entry.stat()
+            else:
+                stat = os.stat(full_path)
+                if not os.path.isfile(full_path):
+                    self._skipped.add(filename)
+                    return False
+        except OSError as e:
+            log.warning("file to filewatcher failed: {0} {1}".format(full_path, str(e)))
+            return False
+        if self.max_age and now - stat.st_mtime > self.max_age:
+            self._skipped.add(filename)
+            return False
+        self.entries[full_path] = {"roomname": roomname, "started": started,
+                                   "mtime": stat.st_mtime, "size": stat.st_size}
+        return True
+
+
+class LogTail(object):
+    """ Reads a chatlog incrementally.
+        The tail remembers the byte offset it has read up to and keeps an
+        incremental decoder, so every call decodes only the bytes EVE
+        appended since the last call. Half written code units and lines
+        are kept back until the rest of them arrives."""
+
+    def __init__(self, path, offset=0):
+        """ path = the chatlog to read
+            offset = byte offset to start at, use the size of the file
+                     to get only the lines written from now on"""
+        self.path = path
+        self.offset = offset
+        self._reset_decoder()
+
+    def _reset_decoder(self):
+        self._decoder = codecs.getincrementaldecoder(LOG_ENCODING)()
+        self._pending = u""
+        # a BOM is only possible at the very beginning of the file
+        self._at_start = (self.offset == 0)
+
+    def read_lines(self):
+        """ Returns a list of all complete lines appended to the file since
+            the last call, without the line endings"""
+        with open(self.path, "rb") as f:
+            f.seek(0, os.SEEK_END)
+            size = f.tell()
+            if size < self.offset:
+                # the file was truncated or replaced: start again
+                self.offset = 0
+                self._reset_decoder()
+            if size == self.offset:
+                return []
+            f.seek(self.offset)
+            data = f.read(size - self.offset)
+        self.offset += len(data)
+        text = self._pending + self._decoder.decode(data)
+        if self._at_start and text:
+            if text.startswith(BOM):
+                text = text[1:]
+            self._at_start = False
+        lines = text.split(u"\n")
+        # the last part is not terminated by a newline (yet)
+        self._pending = lines.pop()
+        return [line.rstrip(u"\r") for line in lines]
+
+
+class Inotify(object):
+    """ Minimal inotify binding (Linux only) to get events for the files in
+        the chatlogs directory the moment EVE writes them.
+        Raises OSError if inotify is not available or does not work on the
+        filesystem of the path."""
+
+    IN_MODIFY = 0x00000002
+    IN_MOVED_FROM = 0x00000040
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_DELETE = 0x00000200
+    IN_Q_OVERFLOW = 0x00004000
+    IN_NONBLOCK = 0o4000
+    IN_CLOEXEC = 0o2000000
+
+    EVENT_HEADER = struct.Struct("iIII")
+
+    def __init__(self, path):
+        if not sys.platform.startswith("linux"):
+            raise OSError("inotify is only available on linux")
+        libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+        if not hasattr(libc, "inotify_init1"):
+            raise OSError("libc without inotify")
+        self.fd = libc.inotify_init1(self.IN_NONBLOCK | self.IN_CLOEXEC)
+        if self.fd < 0:
+            errno = ctypes.get_errno()
+            raise OSError(errno, os.strerror(errno))
+        mask = self.IN_MODIFY | self.IN_CREATE | self.IN_DELETE | self.IN_MOVED_FROM | self.IN_MOVED_TO
+        wd = libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            errno = ctypes.get_errno()
+            os.close(self.fd)
+            raise OSError(errno, os.strerror(errno), path)
+
+    def read_events(self, timeout=None):
+        """ Waits max. timeout seconds for events and returns them as a list
+            of tuples (mask, filename)"""
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return []
+        try:
+            data = os.read(self.fd, 64 * 1024)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos + self.EVENT_HEADER.size <= len(data):
+            _, mask, _, length = self.EVENT_HEADER.unpack_from(data, pos)
+            pos += self.EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip(b"\0")
+            pos += length
+            events.append((mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+
+class PollScheduler(object):
+    """ Decides when a file must be polled the next time.
+        A file that just changed is hot and polled every min_interval
+        seconds. Every poll without a change doubles the interval of the
+        file, up to a maximum. The files of the intel channels never wait
+        longer than max_interval (as long as before we had the scheduler),
+        only the other files (Local, rooms we don't watch, the old logs of
+        other characters) back off up to idle_max_interval and cost nearly
+        nothing."""
+
+    MIN_INTERVAL = 0.25  # seconds
+    MAX_INTERVAL = 1.0  # seconds
+    IDLE_MAX_INTERVAL = 10.0  # seconds
+    BACKOFF = 2.0
+
+    def __init__(self, min_interval=MIN_INTERVAL, max_interval=MAX_INTERVAL, idle_max_interval=IDLE_MAX_INTERVAL):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.idle_max_interval = idle_max_interval
+        self._schedule = {}  # path: [next poll, current interval]
+
+    def __contains__(self, path):
+        return path in self._schedule
+
+    def __len__(self):
+        return len(self._schedule)
+
+    def add(self, path, now=None):
+        if path not in self._schedule:
+            self.promote(path, now)
+
+    def remove(self, path):
+        self._schedule.pop(path, None)
+
+    def promote(self, path, now=None):
+        """ makes the file hot, it will be polled immediately"""
+        if now is None:
+            now = time.time()
+        self._schedule[path] = [now, self.min_interval]
+
+    def changed(self, path, now):
+        entry = self._schedule.get(path)
+        if entry:
+            entry[1] = self.min_interval
+            entry[0] = now + entry[1]
+
+    def unchanged(self, path, now, idle=False):
+        """ idle = the file is not important, it may back off up to
+                   idle_max_interval"""
+        entry = self._schedule.get(path)
+        if entry:
+            max_interval = self.idle_max_interval if idle else self.max_interval
+            entry[1] = min(entry[1] * self.BACKOFF, max_interval)
+            entry[0] = now + entry[1]
+
+    def due(self, now):
+        """ returns all files we must poll now"""
+        return [path for path, entry in list(self._schedule.items()) if entry[0] <= now]
+
+    def next_due(self):
+        """ returns the time of the next poll, None if we have no files"""
+        if not self._schedule:
+            return None
+        return min(entry[0] for entry in list(self._schedule.values()))
+
+
+class ChatlogWatcher(object):
+    """ Watches the chatlogs directory and reports every chatlog which got
+        new content. We watch only the newest files (max_age), not all!
+        Two backends are possible:
+            inotify: event driven, reports changes within milliseconds
+            polling: checks the size of the files, how often depends on how
+                     recently a file changed (see PollScheduler). Use it
+                     where inotify does not work (wine-/network-mounts,
+                     windows)"""
+
+    INOTIFY = "inotify"
+    POLLING = "polling"
+    AUTO = "auto"
+
+    def __init__(self, path, max_age, backend=None, index=None, rescan_interval=None, rooms=None,
+                 max_interval=PollScheduler.MAX_INTERVAL, idle_max_interval=PollScheduler.IDLE_MAX_INTERVAL):
+        """ path = the directory with the chatlogs
+            max_age = only files modified in the last max_age seconds
+            backend = one of INOTIFY, POLLING or AUTO, if None we use the
+                      environment variable VINTEL_FILEWATCHER or AUTO
+            index = a ChatlogIndex of path to use, we create one if None
+            rescan_interval = seconds between two scans of the directory
+                              for new files when polling. None if someone
+                              else calls update_watched_files (f.e. the
+                              FileWatcher on a directory change)
+            rooms = the rooms which matter (the intel channels), their
+                    files and the Local logs are polled at least every
+                    max_interval seconds, all other files back off up to
+                    idle_max_interval when polling. None: all files
+                    matter"""
+        self.path = path
+        self.max_age = max_age
+        self.rescan_interval = rescan_interval
+        self.rooms = rooms
+        self.files = {}  # path: LogTail
+        self.scheduler = PollScheduler(max_interval=max_interval, idle_max_interval=idle_max_interval)
+        self.index = index if index is not None else ChatlogIndex(path, max_age)
+        if backend is None:
+            backend = os.environ.get("VINTEL_FILEWATCHER", self.AUTO).lower()
+        self._inotify = None
+        if backend in (self.AUTO, self.INOTIFY):
+            try:
+                self._inotify = Inotify(path)
+            except (OSError, AttributeError) as e:
+                log.warning("inotify not available, falling back to polling: {0}".format(str(e)))
+        self.backend = self.INOTIFY if self._inotify else self.POLLING
+        log.info("filewatcher backend: {0} on {1}".format(self.backend, path))
+        self.update_watched_files(initial=True)
+
+    @property
+    def rooms(self):
+        return self._rooms
+
+    @rooms.setter
+    def rooms(self, rooms):
+        # replaced as a whole, the polling thread may read it any time
+        self._rooms = None if rooms is None else frozenset(rooms)
+
+    def roomname(self, path):
+        return self.index.roomname(path)
+
+    def is_idle(self, path):
+        """ True if the file is not one of the rooms which matter. Local
+            always matters, the locations of the chars come from there"""
+        rooms = self._rooms
+        if rooms is None:
+            return False
+        roomname = self.roomname(path)
+        return roomname not in rooms and roomname not in LOCAL_NAMES
+
+    def run(self, callback):
+        """ Runs forever. All changes found at once are delivered as one
+            batch: callback(changes) with changes a list of tuples
+            (path, roomname, lines), lines are the new complete lines."""
+        if self.backend == self.INOTIFY:
+            self._run_inotify(callback)
+        else:
+            self._run_polling(callback)
+
+    def _run_polling(self, callback):
+        scheduler = self.scheduler
+        last_rescan = time.time()
+        while True:
+            now = time.time()
+            if self.rescan_interval and now - last_rescan >= self.rescan_interval:
+                self.update_watched_files()
+                last_rescan = now
+            changes = []
+            for path in scheduler.due(now):
+                lines = self.check_file(path)
+                if lines is None:
+                    scheduler.unchanged(path, now, self.is_idle(path))
+                    continue
+                scheduler.changed(path, now)
+                if lines:
+                    changes.append((path, self.roomname(path), lines))
+            if changes:
+                callback(changes)
+            # never sleep longer than min_interval: a directory event may
+            # promote a file in the meantime
+            wait = scheduler.min_interval
+            next_due = scheduler.next_due()
+            if next_due is not None:
+                wait = min(wait, next_due - time.time())
+            if wait > 0:
+                time.sleep(wait)
+
+    def _run_inotify(self, callback):
+        while True:
+            events = self._inotify.read_events()
+            changed = []
+            for mask, name in events:
+                if mask & Inotify.IN_Q_OVERFLOW:
+                    # we lost events, so we must look at every file
+                    self.update_watched_files()
+                    changed.extend(self.files)
+                    continue
+                path = os.path.join(self.path, name)
+                if mask & (Inotify.IN_DELETE | Inotify.IN_MOVED_FROM):
+                    removed = self.index.remove(name)
+                    if removed:
+                        self._apply_index_changes([], [removed])
+                if mask & (Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    added = self.index.add(name)
+                    if added:
+                        self._apply_index_changes([added], [])
+                if mask & (Inotify.IN_MODIFY | Inotify.IN_CREATE | Inotify.IN_MOVED_TO):
+                    if path not in changed:
+                        changed.append(path)
+            changes = []
+            for path in changed:
+                # the event tells us the file changed, no need for a stat
+                lines = self.check_file(path, stat=False)
+                if lines:
+                    changes.append((path, self.roomname(path), lines))
+            if changes:
+                callback(changes)
+
+    def check_file(self, path, stat=True):
+        """ Returns the new lines of the file, an empty list if there is new
+            content but no complete line. Returns None if nothing changed.
+            stat = check the size first, so we open only changed files"""
+        tail = self.files.get(path)
+        if tail is None:
+            return None
+        try:
+            if stat and os.path.getsize(path) == tail.offset:
+                return None
+            offset = tail.offset
+            lines = tail.read_lines()
+        except Exception as e:
+            log.warning("filewatcher-thread error: {0} {1}".format(path, str(e)))
+            return None
+        if tail.offset == offset:
+            return None
+        self.index.touch(path, tail.offset)
+        return lines
+
+    def update_watched_files(self, initial=False):
+        """ initial = files found on the first scan are watched from their
+                      current size on. Later found files are new, so
+                      everything in them is reported."""
+        added, removed, changed = self.index.refresh()
+        if initial:
+            # the index may be filled before
+            added = self.index.paths()
+        self._apply_index_changes(added, removed, initial)
+        # the directory event was caused by these files
+        now = time.time()
+        for path in changed:
+            self.scheduler.promote(path, now)
+
+    def _apply_index_changes(self, added, removed, initial=False):
+        now = time.time()
+        for path in removed:
+            self.files.pop(path, None)
+            self.scheduler.remove(path)
+        for path in added:
+            entry = self.index.entries.get(path)
+            if entry is None:
+                continue
+            self.files[path] = LogTail(path, entry["size"] if initial else 0)
+            self.scheduler.promote(path, now)
@@ -0,0 +1,106 @@
+###########################################################################
+#  Vintel - Visual Intel Chat Analyzer                                    #
+#  Copyright (C) 2014-15 Sebastian Meyer (sparrow.242.de+eve@gmail.com )  #
+#                                                                         #
+#  This program is free software: you can redistribute it and/or modify   #
+#  it under the terms of the GNU General Public License as published by   #
+#  the Free Software Foundation, either version 3 of the License, or      #
+#  (at your option) any later version.                                    #
+#                                                                         #
+#  This program is distributed in the hope that it will be useful,        #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#  GNU General Public License for more details.                           #
+#                                                                         #
+#                                                                         #
+#  You should have received a copy of the GNU General Public License      #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+""" Catching up on the intel we missed while Vintel was not running.
+    The chatparser starts at the end of every log. If we want to know
+    what happened in the last minutes, the intel channels are parsed in a
+    pool of processes. The workers know only the names of the systems and
+    return plain tuples, the chatparser adds them to its state like the
+    messages it parses itself (ChatParser.replay).
+"""
+
+import concurrent.futures
+import multiprocessing
+import os
+import heapq
+import logging
+import time
+
+from vi.chatlogs import read_lines_since
+from vi.chatparser.chatparser import command_status, split_line, TIMESTAMP_FORMAT
+from vi.chatparser.parser_functions import SystemResolver, parse_text
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# the resolver of the worker process, see _init_worker
+_resolver = None
+
+
+def _init_worker(systemnames):
+    global _resolver
+    _resolver = SystemResolver(set(systemnames))
+
+
+def parse_backlog(path, roomname, since, end):
+    """ Parses the messages of the chatlog at path from since (timestamp as
+        string) to the byte offset end. Runs in a worker process.
+        Returns a list of tuples (timestamp, roomname, username, text, html,
+        systemnames, status), ordered by timestamp."""
+    entries = []
+    for line in read_lines_since(path, since, end):
+        parsed = split_line(line)
+        if parsed is None:
+            continue
+        timestamp, username, text = parsed
+        # a KOS request or a soundtest is not intel
+        if command_status(text.upper()) is not None:
+            continue
+        html, systemnames, status = parse_text(text, _resolver)
+        entries.append((timestamp, roomname, username, text, html, systemnames, status))
+    return entries
+
+
+def catch_up(chatparser, minutes, max_workers=None):
+    """ Parses the last minutes of every watched intel channel in a process
+        pool and replays the messages in timestamp order into the
+        chatparser. Returns the messages (see ChatParser.replay)."""
+    started = time.time()
+    oldest = started - minutes * 60
+    since = time.strftime(TIMESTAMP_FORMAT, time.gmtime(oldest))
+    jobs = []
+    for path in chatparser.index.paths():
+        entry = chatparser.index.entries.get(path)
+        if entry is None or entry["roomname"] not in chatparser.rooms or entry["mtime"] < oldest:
+            continue
+        # only up to where the filewatcher has read (it touches the entry
+        # with its offset), the rest comes live
+        jobs.append((path, entry["roomname"], entry["size"]))
+    if not jobs:
+        return []
+    if max_workers is None:
+        # every worker is a new process (spawn), don't start more than we use
+        max_workers = min(len(jobs), os.cpu_count() or 1)
+    results = []
+    # we are called in a thread of a process with Qt (and QtWebEngine) and
+    # other threads running, so the workers must not be forked from it
+    context = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers, mp_context=context, initializer=_init_worker,
+                                                initargs=(list(chatparser.systems),)) as pool:
+        futures = [pool.submit(parse_backlog, path, roomname, since, end) for path, roomname, end in jobs]
+        for future in futures:
+            try:
+                results.append(future.result())
+            except Exception as e:
+                log.error("catching up on a chatlog failed: %s", e)
+    entries = heapq.merge(*results, key=lambda entry: entry[0])
+    messages = chatparser.replay(entries)
+    log.info("caught up on %d messages of the last %d minutes in %.2fs", len(messages), minutes,
+             time.time() - started)
+    return messages
@@ -17,156 +17,293 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
 
+import collections
 import datetime
+import functools
 import os
-import time
 import logging
-from bs4 import BeautifulSoup
-from vi.chatparser.parser_functions import parse_urls, parse_ships, parse_systems, parse_status
+import sys
+from vi.chatlogs import BOM, LOCAL_NAMES, ChatlogIndex, read_header
+from vi.chatparser.parser_functions import SystemResolver, parse_text
 from vi import states
 
-# Names the local chatlogs could start with (depends on l10n of the client)
-LOCAL_NAMES = ("Lokal", "Local")
+
+# what we do with the lines of a chatlog
+ROUTE_INTEL = "intel"      # parse as intel
+ROUTE_LOCAL = "local"      # location of the char
+ROUTE_IGNORED = "ignored"  # a room we don't watch
 
 log = logging.getLogger(__name__)
 log.setLevel(logging.DEBUG)
 
+TIMESTAMP_FORMAT = "%Y.%m.%d %H:%M:%S"
+
+
+@functools.lru_cache(maxsize=256)
+def parse_timestamp(timestr):
+    """ Same as strptime(timestr, TIMESTAMP_FORMAT), but EVE writes the
+        timestamps always the same way (2015.02.12 18:03:21), so we only
+        have to cut it. Everything else goes to strptime, which raises the
+        ValueError if it is no timestamp. Many lines have the same second,
+        so we remember the last ones."""
+    if (len(timestr) == 19 and timestr[4] == "." and timestr[7] == "."
+      and timestr[10] == " " and timestr[13] == ":" and timestr[16] == ":"):
+        digits = timestr[0:4] + timestr[5:7] + timestr[8:10] + timestr[11:13] + timestr[14:16] + timestr[17:19]
+        if digits.isdigit() and digits.isascii():
+            try:
+                return datetime.datetime(int(digits[0:4]), int(digits[4:6]), int(digits[6:8]),
+                                         int(digits[8:10]), int(digits[10:12]), int(digits[12:14]))
+            except ValueError:
+                pass
+    return datetime.datetime.strptime(timestr, TIMESTAMP_FORMAT)
+
+
+def split_line(line):
+    """ Splits a line of a chatlog into a tuple (timestamp, username, text),
+        returns None if the line has no valid timestamp"""
+    # finding the timestamp
+    timestart = line.find("[") + 1
+    timeends = line.find("]")
+    timestr = line[timestart:timeends].strip()
+    try:
+        timestamp = parse_timestamp(timestr)
+    except ValueError:
+        return None
+    # finding the username of the poster
+    userends = line.find(">")
+    username = line[timeends+1:userends].strip()
+    # finding the pure message
+    text = line[userends+1:].strip()
+    return timestamp, username, text
+
+
+def command_status(utext):
+    """ Returns the status of a message which is a command to Vintel and no
+        intel (KOS request, soundtest), None for all others.
+        utext = the text of the message in upper case"""
+    if utext.startswith("XXX "):
+        return states.KOS_STATUS_REQUEST
+    if utext.startswith("VINTELSOUNDTEST"):
+        return states.SOUNDTEST
+    return None
+
+
+class KnownMessages(object):
+    """ The messages we saw in the last max_age seconds, to find the
+        duplicates (f.e. if someone plays > 1 account, every intel
+        channel is in the logs of every account).
+        Lookup is a set, the messages leave the set by their timestamp."""
+
+    def __init__(self, max_age=30*60):
+        self.max_age = datetime.timedelta(seconds=max_age)
+        self._messages = set()
+        self._queue = collections.deque()  # the messages ordered by timestamp
+        self._newest = None                # the newest timestamp we saw
+
+    def __contains__(self, message):
+        return message in self._messages
+
+    def __len__(self):
+        return len(self._messages)
+
+    def add(self, message):
+        if message in self._messages:
+            return
+        self._messages.add(message)
+        self._queue.append(message)
+        if self._newest is None or message.timestamp > self._newest:
+            self._newest = message.timestamp
+        oldest = self._newest - self.max_age
+        while self._queue and self._queue[0].timestamp < oldest:
+            self._messages.discard(self._queue.popleft())
+
+
+class RoomMessages(object):
+    """ The last messages of every room, newest at the end, and the last
+        request (with systems) of every room, so we can find the request
+        a "clear" answers without searching."""
+
+    def __init__(self, size=50):
+        self.size = size
+        self._messages = {}  # roomname: deque of the last messages
+        self._counts = {}    # roomname: how many messages we saw in the room
+        self._requests = {}  # roomname: (count, message) of the last request
+
+    def add(self, message):
+        room = message.room
+        if room not in self._messages:
+            self._messages[room] = collections.deque(maxlen=self.size)
+            self._counts[room] = 0
+        self._messages[room].append(message)
+        self._counts[room] += 1
+        if message.status == states.REQUEST and message.systems:
+            self._requests[room] = (self._counts[room], message)
+
+    def rooms(self):
+        return list(self._messages.keys())
+
+    def messages(self, room):
+        """ Returns a list of the last messages of room"""
+        return list(self._messages.get(room, ()))
+
+    def last_request(self, room, max_search):
+        """ Returns the last request of room if it is one of the last
+            max_search messages of the room, otherwise None"""
+        if room not in self._requests:
+            return None
+        count, message = self._requests[room]
+        if self._counts[room] - count < max_search:
+            return message
+        return None
+
 
 class ChatParser(object):
     """ ChatParser will analyze every new line, that was found inside
     the Chatlogs."""
 
-    def __init__(self, path, rooms, systems):
+    # how many parsed texts we remember. The same intel is often posted in
+    # more than one channel or by more than one pilot ("X in 1DQ")
+    PARSE_CACHE_SIZE = 1024
+
+    def __init__(self, path, rooms, systems, index=None, known_max_age=30*60):
         """ path = the path with the logs
-            rooms = the rooms to parse"""
+            rooms = the rooms to parse
+            index = a ChatlogIndex of path (f.e. the one of the
+                    FileWatcher), we create one if None
+            known_max_age = seconds we remember a message to find the
+                            duplicates"""
         self.path = path          # the path with the chatlog
         self.rooms = rooms        # the rooms to watch (excl. local)
         self.systems = systems    # the known systems as dict name: system
         self.file_data = {}       # informations about the files in the directory
-        self.known_messages = []  # message we allready analyzed
+        self.known_messages = KnownMessages(known_max_age)  # message we allready analyzed
+        self.room_messages = RoomMessages()  # the last messages of every room
         self.locations = {}       # informations about the location of a char
-        self.ignored_pathes = []
-        self._collect_init_filedata(path)
-
-    def _collect_init_filedata(self, path):
-        current_time = time.time()
-        max_diff = 60*60*24  # what is 1 day in seconds
-        for fname in os.listdir(path):
-            full_path = os.path.join(path, fname)
-            file_time = os.path.getmtime(full_path)
-            if current_time - file_time < max_diff:
-                self.add_file(full_path)
+        if index is None:
+            index = ChatlogIndex(path, 60*60*24)  # the logs of 1 day
+            index.refresh()
+        self.index = index
+        self._collect_init_filedata()
+
+    @property
+    def rooms(self):
+        return self._rooms
+
+    @rooms.setter
+    def rooms(self, rooms):
+        """ the rooms to watch (excl. local), the routes of the files
+            must be found again"""
+        self._rooms = frozenset(rooms)
+        self._routes = {}
+
+    @property
+    def systems(self):
+        return self.resolver.systems
+
+    @systems.setter
+    def systems(self, systems):
+        """ the known systems as dict name: system, we build the index
+            for the system names once here"""
+        resolver = SystemResolver(systems)
+        self.resolver = resolver
+        # what we parsed with the old systems is not valid anymore
+        self._parse_text = functools.lru_cache(maxsize=self.PARSE_CACHE_SIZE)(
+            lambda text: parse_text(text, resolver))
+
+    def parse_cache_info(self):
+        """ Returns the hits, misses, maxsize and currsize of the cache of
+            parsed texts (see functools.lru_cache)"""
+        return self._parse_text.cache_info()
+
+    def _collect_init_filedata(self):
+        for full_path in self.index.paths():
+            self.add_file(full_path)
     
     def add_file(self, path):
-        # lines = None
-        # content = ""
+        """ A chatlog which exists when we start. The FileWatcher reads it
+            from its current end on, so we only read the header of the file
+            for the local chats, what was written before is history."""
         filename = os.path.basename(path)
         roomname = filename[:-20]
-        with open(path, "r", encoding="utf-16-le") as f:
-            lines = f.readlines()
-
-        if path not in self.file_data or (roomname in LOCAL_NAMES and "charname" not in self.file_data.get(path, [])):
-            self.file_data[path] = {}
-            if roomname in LOCAL_NAMES:
-                charname = None
-                sessionstart = None  
-                # for local-chats we need more infos
-                for line in lines:
-                    if "Listener:" in line:
-                        charname = line[line.find(":")+1:].strip()
-                    elif "Session started:" in line:
-                        sessionstr = line[line.find(":")+1:].strip()
-                        sessionstart = datetime.datetime.strptime(sessionstr, "%Y.%m.%d %H:%M:%S")
-                    if charname and sessionstart:
-                        self.file_data[path]["charname"] = charname
-                        self.file_data[path]["sessionstart"] = sessionstart
-                        break
-        self.file_data[path]["lines"] = len(lines)
-        return lines
+        self.file_data[path] = {}
+        if roomname in LOCAL_NAMES:
+            # for local-chats we need more infos
+            self._read_header(path)
+
+    def _read_header(self, path):
+        """ Reads the header of the file from disk"""
+        for line in read_header(path):
+            self._parse_header(path, line)
+
+    def _parse_header(self, path, line):
+        """ Looking for the infos in the header of a chatlog"""
+        if "Listener:" in line:
+            self.file_data[path]["charname"] = line[line.find(":")+1:].strip()
+        elif "Session started:" in line:
+            sessionstr = line[line.find(":")+1:].strip()
+            self.file_data[path]["sessionstart"] = parse_timestamp(sessionstr)
 
     def _line_to_message(self, line, roomname):
-        # finding the timestamp
-        timestart = line.find("[") + 1
-        timeends = line.find("]")
-        timestr = line[timestart:timeends].strip()
-        try:
-            timestamp = datetime.datetime.strptime(timestr, "%Y.%m.%d %H:%M:%S")
-        except ValueError:
+        parsed = split_line(line)
+        if parsed is None:
             return None
-        # finding the username of the poster
-        userends = line.find(">")
-        username = line[timeends+1:userends].strip()
-        # finding the pure message
-        text = line[userends+1:].strip()  # text will the text to work an
-        original_text = text
-        formated_text = u"<rtext>{0}</rtext>".format(text)
-        soup = BeautifulSoup(formated_text, "html.parser")
-        rtext = soup.select("rtext")[0]
+        timestamp, username, text = parsed
         systems = set()
-        utext = text.upper()
-        # KOS request
-        if utext.startswith("XXX "):
-            return Message(roomname, text, timestamp, username, systems, utext, status=states.KOS_STATUS_REQUEST)
-        elif utext.startswith("VINTELSOUNDTEST"):
-            return Message(roomname, text, timestamp, username, systems, utext, status=states.SOUNDTEST)
+        # KOS request or soundtest
+        status = command_status(text.upper())
+        if status is not None:
+            return Message(roomname, text, timestamp, username, systems, status=status)
 
         # and now creating message object
-        message = Message(roomname, "", timestamp, username, systems, text, original_text)
+        message = Message(roomname, "", timestamp, username, systems, text)
 
         # is the message allready here? may happen if someone plays > 1 account
         if message in self.known_messages:
             message.status = states.IGNORE
             return message
 
-        # and going on with parsing
-        remove_chars = ("*", "?", ",", "!")
-        for char in remove_chars:
-            text = text.replace(char, "")
-
-        # ships in the message?
-        run = True
-        while run:
-            run = parse_ships(rtext)
-
-        # urls in the message?
-        run = True
-        while run:
-            run = parse_urls(rtext)
-
-        # trying to find the system in the text
-        run = True
-        while run:
-            run = parse_systems(self.systems, rtext, systems)
-
-        # and the status
-        parsed_status = parse_status(rtext)
-        if parsed_status is not None:
-            status = parsed_status
-        else:
-            status = states.ALARM
+        # urls, systems, ships and the status
+        html, systemnames, status = self._parse_text(text)
+        return self._add_message(message, html, systemnames, status)
+
+    def _add_message(self, message, html, systemnames, status):
+        """ Adds the parsed message to the known messages and to its systems"""
+        systems = message.systems
+        for name in systemnames:
+            if name in self.systems:
+                systems.add(self.systems[name])
 
         # if message says clear and no system? Maybe an answer to a request?
         if status == states.CLEAR and not systems:
-            max_search = 2  # we search only max_search messages in the room
-            for count, old_message in \
-                    enumerate(old_message for old_message in self.known_messages[-1::-1] if
-                              old_message.room == roomname):
-                if old_message.systems and old_message.status == states.REQUEST:
-                    for system in old_message.systems:
-                        systems.add(system)
-                    break
-                if count > max_search:
-                    break
-
-        message.message = str(rtext)
+            max_search = 4  # we search only max_search messages in the room
+            request = self.room_messages.last_request(message.room, max_search)
+            if request is not None:
+                for system in request.systems:
+                    systems.add(system)
+
+        message.message = html
         message.status = status
-        self.known_messages.append(message)
+        message.systems = frozenset(systems)
+        self.known_messages.add(message)
+        self.room_messages.add(message)
+
+        for system in message.systems:
+            system.add_message(message)
 
-        if systems:
-            for system in systems:
-                system.messages.append(message)
+        return message
 
-        return message 
+    def replay(self, entries):
+        """ Adds messages parsed somewhere else (f.e. by the backlog parser)
+            entries = tuples (timestamp, roomname, username, text, html,
+                      systemnames, status), ordered by timestamp
+            Returns the messages, like files_changed."""
+        messages = []
+        for timestamp, roomname, username, text, html, systemnames, status in entries:
+            message = Message(roomname, "", timestamp, username, set(), text)
+            if message in self.known_messages:
+                continue
+            messages.append(self._add_message(message, html, systemnames, status))
+        return messages
 
     def _parse_local(self, path, line):
         message = []
@@ -179,7 +316,7 @@ class ChatParser(object):
         timestart = line.find("[") + 1
         timeends = line.find("]")
         timestr = line[timestart:timeends].strip()
-        timestamp = datetime.datetime.strptime(timestr, "%Y.%m.%d %H:%M:%S")
+        timestamp = parse_timestamp(timestr)
         # finding the username of the poster
         userends = line.find(">")
         username = line[timeends+1:userends].strip()
@@ -193,35 +330,59 @@ class ChatParser(object):
             if timestamp > self.locations[charname]["timestamp"]:
                 self.locations[charname]["system"] = system
                 self.locations[charname]["timestamp"] = timestamp
-                message = Message("", "", timestamp, charname, [system, ], "", status=states.LOCATION)
+                message = Message("", "", timestamp, charname, [system, ], status=states.LOCATION)
         return message
 
-    def file_modified(self, path, roomname):
-        messages = []
-        filename = os.path.basename(path)
+    def _route(self, path, roomname):
+        """ Returns what to do with the lines of the file at path, one of
+            ROUTE_INTEL, ROUTE_LOCAL, ROUTE_IGNORED"""
+        routes = self._routes
+        route = routes.get(path)
+        if route is None:
+            if roomname in LOCAL_NAMES:
+                route = ROUTE_LOCAL
+            elif roomname in self._rooms:
+                route = ROUTE_INTEL
+            else:
+                route = ROUTE_IGNORED
+            routes[path] = route
+        return route
 
-        if roomname not in self.rooms and roomname not in LOCAL_NAMES:
-            self.ignored_pathes.append(filename)
+    def files_changed(self, changes):
+        """ Parses a batch of changes, as delivered by the FileWatcher.
+            changes = list of tuples (path, roomname, new lines)"""
+        messages = []
+        for path, roomname, lines in changes:
+            # one broken file must not cost us the lines of the others,
+            # they are read and will never come again
+            try:
+                messages.extend(self.lines_added(path, roomname, lines))
+            except Exception as e:
+                log.error("parsing the new lines of %s failed: %s", path, e)
+        return messages
 
-        if filename in self.ignored_pathes:
-            # log.debug('file {0} is ignored'.format(filename))
+    def lines_added(self, path, roomname, lines):
+        """ Parses the new lines of a file, returns the messages"""
+        messages = []
+        route = self._route(path, roomname)
+        if route == ROUTE_IGNORED:
             return messages
 
-        # checking if we must do anything with the changed file.
-        # we are only need those, which name is in the rooms-list
-        # EvE names the file like room_20140913_200737.txt, so we don't need
-        # the last 20 chars
-        if path not in self.file_data:
-            # seems eve created a new file. New Files have 12 lines header
-            self.file_data[path] = {"lines": 13}
-
-        old_length = self.file_data[path]["lines"]
-        lines = self.add_file(path)
-
-        for line in lines[old_length-1:]:
-            line = line.strip()
+        data = self.file_data.setdefault(path, {})
+        for line in lines:
+            # EVE starts the lines with a BOM sometimes
+            line = line.strip().lstrip(BOM)
+            if not line.startswith("["):
+                # no message, the header of a new file
+                if route == ROUTE_LOCAL and not data.get("header_done"):
+                    self._parse_header(path, line)
+                continue
+            data["header_done"] = True
             if len(line) > 2:
-                if roomname in LOCAL_NAMES:
+                if route == ROUTE_LOCAL:
+                    if "charname" not in data:
+                        # we missed the header of the file
+                        self._read_header(path)
                     message = self._parse_local(path, line)
                 else:
                     message = self._line_to_message(line, roomname)
@@ -232,18 +393,34 @@ class ChatParser(object):
 
 
 class Message(object):
-   
-    def __init__(self, room, message, timestamp, user, systems, utext, plain_text="", status=states.ALARM):
-        self.room = room              # chatroom the message was posted
+    """ A message of a chatroom. The chatparser sets message (the html)
+        and status when it is parsed, everything else never changes.
+        There are a lot of messages in a long session, so no __dict__ and
+        the names of rooms and users are interned."""
+
+    __slots__ = ("room", "message", "timestamp", "user", "systems", "status", "plain_text", "_widgets")
+
+    def __init__(self, room, message, timestamp, user, systems, plain_text="", status=states.ALARM):
+        self.room = sys.intern(room)  # chatroom the message was posted
         self.message = message        # the messages text
         self.timestamp = timestamp    # time stamp of the massage
-        self.user = user              # user who posted the message
+        self.user = sys.intern(user)  # user who posted the message
         self.systems = systems        # list of systems mentioned in the message
         self.status = status          # status related to the message
-        self.utext = utext            # the text in UPPER CASE
         self.plain_text = plain_text  # plain text of the message, as posted
-        # if you add the message to a widget, please add it to widgets
-        self.widgets = []
+        self._widgets = None
+
+    @property
+    def utext(self):
+        """ the text in UPPER CASE"""
+        return (self.plain_text or self.message).upper()
+
+    @property
+    def widgets(self):
+        """ if you add the message to a widget, please add it to widgets"""
+        if self._widgets is None:
+            self._widgets = []
+        return self._widgets
 
     def __key(self):
         return self.room, self.plain_text, self.timestamp, self.user
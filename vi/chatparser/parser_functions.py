@@ -20,23 +20,17 @@
 """ 12.02.2015
     I know this is a little bit dirty, but I prefer to have all the functions
     to parse the chat in this file together.
-    Wer are now work directly with the html-formated text, which we use to
-    display it. We are using a HTML/XML-Parser to have the benefit, that we
-    can only work and analyze those text, that is still not on tags, because
-    all the text in tags was allready identified.
-    f.e. the ship_parser:
-        we call it from the chatparser and give them the rtext (richtext).
-        if the parser hits a shipname, it will modifiy the tree by creating
-        a new tag and replace the old text with it (calls tet_replace),
-        than it returns True.
-        The chatparser will call the function again until it return False
-        (None is False) otherwise.
-        We have to call the parser again after a hit, because a hit will change
-        the tree and so the original generator is not longer stable.
+    The rtext (richtext) of a message is a RichText: the plain text of the
+    message as a list of parts, where every part is still plain text or
+    something we identified (ship, system, url).
+    The finders (find_ships, find_urls, find_systems) only return the
+    positions of their hits in the plain text. annotate() asks them all
+    once, drops the hits which overlap a better one (url before system
+    before ship) and marks the rest in the rtext in one go.
+    The html is rendered only once, when the message is finished.
 """
 
-from bs4 import BeautifulSoup
-from bs4.element import NavigableString
+import html
 
 import vi.evegate as evegate
 from vi import states
@@ -44,19 +38,77 @@ from vi import states
 
 chars_to_ignore = ("*", "?", ",", "!")
 
-def text_replace(element, new_text):
-    new_text = "<t>" + new_text + "</t>"
-    new_elements = []
-    for new_part in BeautifulSoup(new_text, "html.parser").select("t")[0].contents:
-        new_elements.append(new_part)
-    for new_element in new_elements:
-        element.insert_before(new_element)
-    element.replace_with(str(""))
+
+class RichText(object):
+    """ The text of a message and the parts of it which are identified.
+        parts is a list of str (not identified text) and tuples
+        (kind, text, target) for the identified parts."""
+
+    SHIP = "ship"
+    SYSTEM = "system"
+    URL = "url"
+
+    SHIP_HTML = u"""<span style="color:#d95911;font-weight:bold">
+                    {text}</span>"""
+    SYSTEM_HTML = u"""<a href={target} style="color:#CC8800;font-weight:bold">{text}</a>"""
+    URL_HTML = u"""<a href={target} style="color:#28a5ed;font-weight:bold">{text}</a>"""
+
+    def __init__(self, text):
+        """ text = the message as it is in the log. It was html before, so
+            entities in it are decoded"""
+        self.parts = [html.unescape(text)]
+
+    def texts(self):
+        """ Returns a list of tuples (index, text) for all parts of the
+            text which are not identified yet"""
+        return [(index, part) for index, part in enumerate(self.parts) if isinstance(part, str)]
+
+    def annotate(self, index, spans):
+        """ Identifies parts of the not identified part index.
+            spans = sorted, not overlapping list of tuples
+                    (start, end, kind, target), start and end in the part"""
+        text = self.parts[index]
+        new_parts = []
+        position = 0
+        for start, end, kind, target in spans:
+            if start > position:
+                new_parts.append(text[position:start])
+            new_parts.append((kind, text[start:end], target))
+            position = end
+        if position < len(text):
+            new_parts.append(text[position:])
+        self.parts[index:index+1] = new_parts
+
+    def __str__(self):
+        rendered = [u"<rtext>"]
+        for part in self.parts:
+            if isinstance(part, str):
+                rendered.append(html.escape(part, quote=False))
+                continue
+            kind, text, target = part
+            text = html.escape(text, quote=False)
+            if kind == self.SHIP:
+                rendered.append(self.SHIP_HTML.format(text=text))
+            elif kind == self.SYSTEM:
+                rendered.append(self.SYSTEM_HTML.format(text=text, target=_attribute(u"mark_system/" + target)))
+            elif kind == self.URL:
+                rendered.append(self.URL_HTML.format(text=text, target=_attribute(u"link/" + target)))
+        rendered.append(u"</rtext>")
+        return u"".join(rendered)
+
+
+def _attribute(value):
+    """ quotes a value for a html attribute"""
+    value = html.escape(value, quote=False)
+    if '"' not in value:
+        return u'"{0}"'.format(value)
+    if "'" not in value:
+        return u"'{0}'".format(value)
+    return u'"{0}"'.format(value.replace('"', "&quot;"))
 
 
 def parse_status(rtext):
-    texts = [t for t in rtext.contents if isinstance(t, NavigableString)]
-    for text in texts:
+    for _, text in rtext.texts():
         utext = text.strip().upper()
         for char in chars_to_ignore:
             utext = utext.replace(char, "")
@@ -72,126 +124,208 @@ def parse_status(rtext):
                                        "STILL BLUE", "ALL BLUES")):
             return states.CLEAR
 
-def parse_ships(rtext):
-
-    def format_shipname(text, word):
-        new_text = u"""<span style="color:#d95911;font-weight:bold">
-                    {0}</span>"""
-        text = text.replace(word, new_text.format(word))
-        return text
-    
-    texts = [t for t in rtext.contents if isinstance(t, NavigableString)]
-    for text in texts:
-        utext = text.upper()
-        for shipname in evegate.SHIPNAMES:
-            if shipname in utext:
-                hit = True
-                start = utext.find(shipname)
-                end = start+len(shipname)
-                if ((start > 0 and utext[start-1] not in (" ", "X"))
-                  or (end < len(utext)-1 and utext[end] not in ("S"," "))):
-                    hit = False
-                if hit:
-                    shipintext = text[start:end]
-                    formated = format_shipname(text, shipintext)
-                    text_replace(text, formated)
-                    return True
-
-
-
-def parse_systems(systems, rtext, found_systems):
+
+class AhoCorasick(object):
+    """ Finds all occurrences of many words in a text in one pass"""
+
+    def __init__(self, words):
+        self._goto = [{}]     # node: {char: next node}
+        self._fail = [0]
+        self._output = [[]]   # node: words ending here
+        for word in words:
+            node = 0
+            for char in word:
+                next_node = self._goto[node].get(char)
+                if next_node is None:
+                    next_node = len(self._goto)
+                    self._goto[node][char] = next_node
+                    self._goto.append({})
+                    self._fail.append(0)
+                    self._output.append([])
+                node = next_node
+            self._output[node].append(word)
+        # breadth first to set the fail links
+        queue = list(self._goto[0].values())
+        for node in queue:
+            for char, next_node in self._goto[node].items():
+                queue.append(next_node)
+                fail = self._fail[node]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_node] = self._goto[fail].get(char, 0)
+                if self._fail[next_node] == next_node:
+                    self._fail[next_node] = 0
+                self._output[next_node] = self._output[next_node] + self._output[self._fail[next_node]]
+
+    def find_all(self, text):
+        """ Returns a list of tuples (start, end, word) for all occurrences"""
+        goto = self._goto
+        fail = self._fail
+        output = self._output
+        found = []
+        node = 0
+        for position, char in enumerate(text):
+            while node and char not in goto[node]:
+                node = fail[node]
+            node = goto[node].get(char, 0)
+            for word in output[node]:
+                found.append((position + 1 - len(word), position + 1, word))
+        return found
+
+
+_ship_automaton = None
+
+
+def find_ships(text):
+    """ Returns a sorted list of not overlapping tuples (start, end, shipname)
+        for all ships in text.
+        A ship must stand on its own: before it a space or a X (3xLoki), after
+        it a space or a S (Lokis)."""
+    global _ship_automaton
+    if _ship_automaton is None:
+        _ship_automaton = AhoCorasick(evegate.SHIPNAMES)
+    utext = text.upper()
+    if len(utext) != len(text):
+        # some chars get longer in upper case, keep them, we need the positions
+        utext = u"".join(c.upper() if len(c.upper()) == 1 else c for c in text)
+    hits = []
+    for start, end, shipname in _ship_automaton.find_all(utext):
+        if ((start > 0 and utext[start-1] not in (" ", "X"))
+          or (end < len(utext)-1 and utext[end] not in ("S", " "))):
+            continue
+        hits.append((start, end, shipname))
+    # the longest ship wins, if they overlap
+    hits.sort(key=lambda hit: (hit[0], hit[0] - hit[1]))
+    ships = []
+    position = 0
+    for start, end, shipname in hits:
+        if start >= position:
+            ships.append((start, end, shipname))
+            position = end
+    return ships
+
+
+class SystemResolver(object):
+    """ Finds the system a word in the chat means. The rules are:
+        - the name of the system
+        - words with 2-4 chars are the beginning of a name (1DQ for 1DQ1-A)
+        - words with a minus are the first chars of the both parts
+          (I-I for I43-IF3)
+        - longer words are the beginning of the name without the minus
+          (FYH58 for F-YH58)
+        If more than one system matches, the first one in systems wins.
+        All abbreviations are computed once, so resolve() is only a lookup."""
+
+    def __init__(self, systems):
+        """ systems = the names of the known systems (f.e. the dict
+            name: system)"""
+        self.systems = systems
+        self._prefixes = {}    # 2-4 chars: name
+        self._initials = {}    # (first char, first char after the -): name
+        self._stripped = {}    # min. 5 chars of the name without the -: name
+        for name in systems:
+            for length in range(2, min(len(name), 4) + 1):
+                self._add(self._prefixes, name[:length], name)
+            parts = name.split("-")
+            if len(parts) == 2 and len(parts[0]) > 1 and len(parts[1]) > 1:
+                self._add(self._initials, (parts[0][0], parts[1][0]), name)
+            stripped = name.replace("-", "")
+            for length in range(5, len(stripped) + 1):
+                self._add(self._stripped, stripped[:length], name)
+
+    def _add(self, index, key, name):
+        if key not in index:
+            index[key] = name
+
+    def resolve(self, uword):
+        """ Returns the name of the system uword (upper case) means or None"""
+        if uword in self.systems:
+            return uword
+        if 1 < len(uword) < 5:
+            return self._prefixes.get(uword)
+        if "-" in uword:
+            parts = uword.split("-")
+            if len(parts) == 2 and len(parts[0]) > 1 and len(parts[1]) > 1:
+                return self._initials.get((parts[0][0], parts[1][0]))
+            return None
+        return self._stripped.get(uword)
+
+
+def find_systems(resolver, text):
+    """ Returns a list of tuples (start, end, systemname) for all words in
+        text which are a system"""
 
     # words to ignore on the system parser. use UPPER CASE
     WORDS_TO_IGNORE = ("IN", "IS", "AS")
-    
-    def format_system(text, word, system):
-        new_text = u"""<a style="color:#CC8800;font-weight:bold" 
-                    href="mark_system/{0}">{1}</a>"""
-        text = text.replace(word, new_text.format(system, word))
-        return text
-
-    sys_names = systems.keys()
-    texts = [t for t in rtext.contents if isinstance(t, NavigableString)]
-    for text in texts:
-        worktext = text
+
+    systems = []
+    position = 0
+    for token in text.split(" "):
+        start = position
+        position += len(token) + 1
+        word = token
         for char in chars_to_ignore:
-            worktext = worktext.replace(char, "")
-        words = worktext.split(" ")
-        for word in words:
-            if len(word.strip()) == 0:
+            word = word.replace(char, "")
+        if len(word.strip()) == 0:
+            continue
+        uword = word.upper()
+        if uword != word and uword in WORDS_TO_IGNORE: continue
+        # the word is not in the text if there was a char to ignore in it
+        offset = token.find(word)
+        if offset < 0: continue
+        system = resolver.resolve(uword)
+        if system is not None:
+            systems.append((start + offset, start + offset + len(word), system))
+    return systems
+
+
+def find_urls(text):
+    """ Returns a list of tuples (start, end, url) for all urls in text"""
+    # yes, this is faster than regex and less complex to read
+    urls = []
+    prefixes = ("http://", "https://")
+    for prefix in prefixes:
+        start = 0
+        while start >= 0:
+            start = text.find(prefix, start)
+            if start >= 0:
+                stop = text.find(" ", start)
+                if stop < 0:
+                    stop = len(text)
+                urls.append((start, stop, text[start:stop]))
+                start += 1
+    return urls
+
+
+def annotate(rtext, resolver, found_systems):
+    """ Marks all urls, systems and ships in the rtext and adds the names of
+        the found systems to found_systems"""
+    for index, text in rtext.texts():
+        taken = bytearray(len(text))
+        spans = []
+        hits = ([(start, end, RichText.URL, url) for start, end, url in sorted(find_urls(text))]
+                + [(start, end, RichText.SYSTEM, name) for start, end, name in find_systems(resolver, text)]
+                + [(start, end, RichText.SHIP, None) for start, end, _ in find_ships(text)])
+        for start, end, kind, target in hits:
+            if any(taken[start:end]):
                 continue
-            uword = word.upper()
-            if uword != word and uword in WORDS_TO_IGNORE: continue
-            if uword in sys_names:                   # - direct hit on name
-                found_systems.add(systems[uword])    #   of the system?
-                formated_text = format_system(text, word, uword)
-                text_replace(text, formated_text)
-                return True
-            elif 1 < len(uword) < 5:  # - uword < 4 chars.
-                for system in sys_names:             #   system begins with?
-                    if system.startswith(uword):
-                        found_systems.add(systems[system])
-                        formated_text = format_system(text, word,
-                                                      system)
-                        text_replace(text, formated_text)
-                        return True
-            elif "-" in uword and len(uword) > 2:  # - short with - (minus)
-                uword_parts = uword.split("-")     #   (I-I will bis I43-IF3)
-                for system in sys_names:
-                    system_parts = system.split("-")
-                    if (len(uword_parts) == 2 and
-                        len(system_parts) == 2 and
-                        len(uword_parts[0]) > 1 and
-                        len(uword_parts[1]) > 1 and
-                        len(system_parts[0]) > 1 and
-                        len(system_parts[1]) > 1 and
-                        len(uword_parts) == len(system_parts) and
-                        uword_parts[0][0] == system_parts[0][0] and 
-                        uword_parts[1][0] == system_parts[1][0]):
-                        found_systems.add(systems[system])
-                        formated_text = format_system(text, word,
-                                                      system)
-                        text_replace(text, formated_text)
-                        return True
-            elif len(uword) > 1:  # what if F-YH58 is named FY?
-                for system in sys_names:
-                    cleared_system = system.replace("-", "")
-                    if cleared_system.startswith(uword):
-                        found_systems.add(systems[system])
-                        formated_text = format_system(text, word,
-                                                      system)
-                        text_replace(text, formated_text)
-                        return True
-
-
-
-def parse_urls(rtext):
-
-    def find_urls(s):
-        # yes, this is faster than regex and less complex to read
-        urls = []
-        prefixes = ("http://", "https://")
-        for prefix in prefixes:
-            start = 0
-            while start >= 0:
-                start = s.find(prefix, start)
-                if start >= 0:
-                    stop = s.find(" ", start)
-                    if stop < 0:
-                        stop = len(s)
-                    urls.append(s[start:stop])
-                    start += 1
-        return urls
-    
-    def format_url(text, url):
-        new_text = u"""<a style="color:#28a5ed;font-weight:bold"
-                       href="link/{0}">{0}</a>"""
-        text = text.replace(url, new_text.format(url))
-        return text
-
-    texts = [t for t in rtext.contents if isinstance(t, NavigableString)]
-    for text in texts:
-        urls = find_urls(text)
-        for url in urls:
-            text_replace(text, format_url(text, url))
-            return True
+            taken[start:end] = b"\x01" * (end - start)
+            spans.append((start, end, kind, target))
+            if kind == RichText.SYSTEM:
+                found_systems.add(target)
+        if spans:
+            spans.sort()
+            rtext.annotate(index, spans)
+
+
+def parse_text(text, resolver):
+    """ Parses the text of a message. Returns a tuple (html, systemnames,
+        status), needs no objects of the map, only the names of the systems
+        in the resolver."""
+    rtext = RichText(text)
+    systemnames = set()
+    annotate(rtext, resolver, systemnames)
+    status = parse_status(rtext)
+    if status is None:
+        status = states.ALARM
+    return str(rtext), tuple(sorted(systemnames)), status
@@ -0,0 +1,194 @@
+###########################################################################
+#  Vintel - Visual Intel Chat Analyzer                                    #
+#  Copyright (C) 2014-15 Sebastian Meyer (sparrow.242.de+eve@gmail.com )  #
+#                                                                         #
+#  This program is free software: you can redistribute it and/or modify   #
+#  it under the terms of the GNU General Public License as published by   #
+#  the Free Software Foundation, either version 3 of the License, or      #
+#  (at your option) any later version.                                    #
+#                                                                         #
+#  This program is distributed in the hope that it will be useful,        #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#  GNU General Public License for more details.                           #
+#                                                                         #
+#                                                                         #
+#  You should have received a copy of the GNU General Public License      #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+""" The parsed messages as a stream.
+    Everyone who wants the messages (the map, the notifications, an
+    exporter, a test) subscribes to the MessageStream and iterates over
+    the subscription:
+
+        subscription = stream.subscribe()
+        for message in subscription:
+            ...
+
+    Every subscription has its own bounded queue. If a subscriber is too
+    slow and its queue is full, the stream waits for it (block=True,
+    backpressure up to the parser and the filewatcher) or the oldest
+    message in the queue is dropped (block=False).
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# how often a waiting subscriber or publisher looks if the stream is closed
+_WAIT = 0.5
+
+# how often an async subscriber looks for new messages. It never blocks
+# a thread, so a cancelled "async for" loses nothing
+_ASYNC_WAIT = 0.05
+
+
+class Subscription(object):
+    """ The messages of a MessageStream for one subscriber, iterable and
+        async iterable. The iteration ends when the stream or the
+        subscription is closed."""
+
+    def __init__(self, stream, maxsize, block):
+        self.stream = stream
+        self.block = block
+        self.dropped = 0  # messages we lost because the queue was full (block=False)
+        self._queue = queue.Queue(maxsize)
+        self._closed = False
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def put(self, message):
+        """ Called by the stream"""
+        if self.block:
+            while not self._closed:
+                try:
+                    self._queue.put(message, timeout=_WAIT)
+                    return
+                except queue.Full:
+                    pass
+            return
+        while True:
+            try:
+                self._queue.put_nowait(message)
+                return
+            except queue.Full:
+                try:
+                    self._queue.get_nowait()
+                    self.dropped += 1
+                except queue.Empty:
+                    pass
+
+    def get(self, timeout=None):
+        """ Returns the next message. Raises StopIteration if the
+            subscription is closed and empty, queue.Empty after timeout"""
+        waited = 0.0
+        while True:
+            wait = _WAIT if timeout is None else min(_WAIT, timeout - waited)
+            try:
+                return self._queue.get(timeout=max(wait, 0))
+            except queue.Empty:
+                if self._closed:
+                    raise StopIteration()
+                waited += wait
+                if timeout is not None and waited >= timeout:
+                    raise
+
+    def get_batch(self, max_items=None, timeout=None):
+        """ Waits for the next message and returns it with all messages
+            which are waiting behind it (max. max_items) as a list"""
+        messages = [self.get(timeout)]
+        while max_items is None or len(messages) < max_items:
+            try:
+                messages.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return messages
+
+    def close(self):
+        self._closed = True
+        self.stream.unsubscribe(self)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        return self.get()
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        while True:
+            try:
+                return self._queue.get_nowait()
+            except queue.Empty:
+                pass
+            if self._closed:
+                # the last message may have come just before the close
+                try:
+                    return self._queue.get_nowait()
+                except queue.Empty:
+                    raise StopAsyncIteration()
+            await asyncio.sleep(_ASYNC_WAIT)
+
+
+class MessageStream(object):
+    """ Delivers the messages of the chatparser to all subscriptions"""
+
+    def __init__(self):
+        self._subscriptions = []
+        self._lock = threading.Lock()
+        self.closed = False
+
+    def subscribe(self, maxsize=1000, block=True):
+        """ Returns a new Subscription
+            maxsize = how many messages may wait for the subscriber
+            block = if the queue is full: wait for the subscriber (True)
+                    or drop the oldest message in the queue (False)"""
+        subscription = Subscription(self, maxsize, block)
+        with self._lock:
+            if self.closed:
+                subscription._closed = True
+            else:
+                self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        with self._lock:
+            if subscription in self._subscriptions:
+                self._subscriptions.remove(subscription)
+        subscription._closed = True
+
+    def publish(self, messages):
+        """ Sends the messages (a list) to all subscriptions"""
+        with self._lock:
+            subscriptions = list(self._subscriptions)
+        for message in messages:
+            for subscription in subscriptions:
+                subscription.put(message)
+
+    def close(self):
+        """ Ends the iteration of all subscriptions after their last
+            message"""
+        with self._lock:
+            self.closed = True
+            subscriptions, self._subscriptions = self._subscriptions, []
+        for subscription in subscriptions:
+            subscription._closed = True
+
+    def watch(self, watcher, chatparser, prepare=None):
+        """ Runs the watcher (a ChatlogWatcher) in this thread and publishes
+            everything the chatparser finds in the changes. Never returns.
+            prepare = a function which gets the messages of a batch and
+                      returns the list we publish (f.e. records of them)"""
+        def changed(changes):
+            messages = chatparser.files_changed(changes)
+            self.publish(prepare(messages) if prepare else messages)
+        watcher.run(changed)
@@ -21,16 +21,21 @@
 # Little lib and tool to get the map and information from dotlan          #
 ###########################################################################
 
+import collections
+import datetime
+import heapq
+import itertools
 import logging
 import math
 import re
 import time
+import xml.etree.ElementTree as ElementTree
+from concurrent.futures import ThreadPoolExecutor
 
 import bs4
 import requests
 from bs4 import BeautifulSoup
 
-import vi.drachenjaeger
 import vi.evegate
 from vi import states
 from vi.cache.cache import Cache
@@ -59,6 +64,10 @@ class Map(object):
 
     DOTLAN_BASIC_URL = "http://evemaps.dotlan.net/svg/{0}.svg"
 
+    # the elements _index_soup collects while building the map
+    INDEXED_TAGS = ("svg", "use", "symbol", "line", "script", "style")
+    INDEXED_IDS = ("controls", "jumps")
+
     @property
     def svg(self):
         # rerender all systems
@@ -110,21 +119,74 @@ class Map(object):
         # and now creating soup from the svg
         # self.soup = BeautifulSoup(svg, "html.parser")
         self.soup = BeautifulSoup(svg, "xml")
-        self.systems = self._extract_systems_from_soup(self.soup)
+        elements = self._index_soup(self.soup)
+        self.systems = self._extract_systems_from_soup(elements)
         self.systems_by_id = {}
         for system in self.systems.values():
             self.systems_by_id[system.systemid] = system
-        self._preparing_svg(self.soup, self.systems)
-        self._connect_neighbours()
+        self._preparing_svg(self.soup, elements)
+        self._connect_neighbours(elements)
+        self.distances = JumpDistances(self.systems.values())
+        self.distances.precompute()
+        self.router = Router(self.systems.values(), self.distances)
+        # the regions around, set when they are loaded (see Universe.around)
+        self.universe = None
+        self.character_locations = {}  # charname: systemname
+        self.located_characters = {}   # systemname: set of charnames
         self._jumpmaps_visible = False
         self._statistics_visible = False
-        self.marker = self.soup.select("#select_marker")[0]
+        self.marker = elements["#select_marker"]
 
     def set_system_status(self, sysname, status):
         self.systems[sysname].set_status(status)
         log.debug('sig_status_changed: {0} {1}'.format(sysname, status))
         # self.sig_system_status_changed.emit(sysname, status)
         
+    def set_character_location(self, charname, systemname):
+        """ The char is now in the system with systemname. A name which is
+            neither on this map nor in the universe ("?", a region far
+            away) only forgets where the char was"""
+        old_systemname = self.character_locations.pop(charname, None)
+        if old_systemname is not None:
+            chars = self.located_characters[old_systemname]
+            chars.discard(charname)
+            if not chars:
+                del self.located_characters[old_systemname]
+        universe = self.universe
+        if systemname in self.systems or (universe is not None and systemname in universe.neighbours):
+            self.character_locations[charname] = systemname
+            self.located_characters.setdefault(systemname, set()).add(charname)
+
+    def characters_within(self, system, distance, with_bridges=False):
+        """ Returns the located chars within distance jumps of system as
+            a list of (charname, name of the system of the char, distance),
+            the nearest first. If we have a universe, we count the jumps
+            across the borders of the region too.
+            with_bridges = the jumpbridges of the map count too (the
+                           shorter of the way over the bridges in the
+                           region and the way through the gates wins)"""
+        universe = self.universe
+        if universe is not None and system.name in universe.neighbours:
+            distance_of = universe.distances.distances_from(system.name).get
+        else:
+            distances = self.distances.distances_from(system)
+            distance_of = lambda systemname: distances.get(self.systems.get(systemname))
+        if with_bridges:
+            bridge_distances = {other.name: d for other, d in self.router.within(system, distance).items()}
+        else:
+            bridge_distances = {}
+        result = []
+        for systemname, chars in self.located_characters.items():
+            char_distance = distance_of(systemname)
+            bridge_distance = bridge_distances.get(systemname)
+            if bridge_distance is not None and (char_distance is None or bridge_distance < char_distance):
+                char_distance = bridge_distance
+            if char_distance is not None and char_distance <= distance:
+                for charname in chars:
+                    result.append((charname, systemname, char_distance))
+        result.sort(key=lambda entry: (entry[2], entry[0]))
+        return result
+
     def change_jumpbrigde_visibility(self):
         new_status = False if self._jumpmaps_visible else True
         value = "visible" if new_status else "hidden"
@@ -139,14 +201,29 @@ class Map(object):
             line["visibility"] = value
         self._statistics_visible = new_status
 
-    def _extract_systems_from_soup(self, soup):
+    def _index_soup(self, soup):
+        """ Walks one time through the whole soup and collects the elements
+            we need to build the map (soup.select() walks the whole soup
+            for every call). Returns a dict tagname: list of elements for
+            the tags in INDEXED_TAGS and "#id": element for INDEXED_IDS"""
+        elements = {name: [] for name in self.INDEXED_TAGS}
+        for element in soup.descendants:
+            if not isinstance(element, bs4.element.Tag):
+                continue
+            if element.name in elements:
+                elements[element.name].append(element)
+            elementid = element.get("id")
+            if elementid in self.INDEXED_IDS:
+                elements["#" + elementid] = element
+        return elements
+
+    def _extract_systems_from_soup(self, elements):
         systems = {}
         uses = {}
-        for use in soup.select("use"):
+        for use in elements["use"]:
             useid = use["xlink:href"][1:]
             uses[useid] = use
-        symbols = soup.select("symbol")
-        for symbol in symbols:
+        for symbol in elements["symbol"]:
             symbolid = symbol["id"]
             systemid = symbolid[3:]
 
@@ -156,14 +233,14 @@ class Map(object):
 
             # for element in symbol.select(".sys"):
             for element in symbol.find_all(class_=re.compile('^sys\s')):
-                name = element.select("text")[0].text.strip().upper()
+                name = element.find("text").text.strip().upper()
                 # element['href'] = 'vintel://go_system/{0}'.format(name)
                 # element['onclick'] = 'alert("check")'
                 element['data-systemname'] = name
                 element['data-systemid'] = systemid
                 del element['target']
 
-                for sub_elm in element.select(".s"):
+                for sub_elm in element.find_all(class_="s"):
                     if sub_elm['class'] == 's':
                         del sub_elm['style']
 
@@ -182,12 +259,13 @@ class Map(object):
     # def system_status_changed(self, sysname, newstatus):
     #    self.sig_system_status_changed.emit(sysname, newstatus)
 
-    def _connect_neighbours(self):
+    def _connect_neighbours(self, elements):
         """This will find all neigbours of the systems and connect them.
            It takes a look to all the jumps on the map and get the system under
            which the line ends"""
-        for jump in self.soup.select("#jumps")[0].select(".j"):
-            if "jumpbridge" in jump["class"]: continue
+        jumps = elements["#jumps"]
+        for jump in elements["line"]:
+            if jump.parent is not jumps: continue
             parts = jump["id"].split("-")
             if parts[0] == "j":
                 start_system = self.systems_by_id[parts[1]]
@@ -246,20 +324,23 @@ class Map(object):
                 line["marker-end"] = "url(#arrowend_{0})".format(jb_color)
             jumps.insert(0, line)
             color_count += 1
+        self.router.set_jumpbridges((self.systems[start], linetype, self.systems[stop])
+                                    for start, linetype, stop in jumpbridge_data
+                                    if start in self.systems and stop in self.systems)
     
-    def _preparing_svg(self, soup, systems):
+    def _preparing_svg(self, soup, elements):
         for e in self.soup:
             if isinstance(e, bs4.element.ProcessingInstruction) or isinstance(e, bs4.element.Doctype):
                 e.extract()
                 break
 
-        for elm in self.soup.find_all('script'):
+        for elm in elements["script"]:
             elm.extract()
 
-        for elm in self.soup.find_all('style'):
+        for elm in elements["style"]:
             elm.extract()
 
-        svg = soup.select("svg")[0]
+        svg = elements["svg"][0]
         # svg["onmousedown"] = "return false;"
         del svg["onmousedown"]
         del svg["onload"]
@@ -268,10 +349,10 @@ class Map(object):
         # qrc:///qtwebchannel/qwebchannel.js
         # http://doc.qt.io/qt-5/qtwebchannel-javascript.html
 
-        soup.select('#controls')[0].extract()
+        elements["#controls"].extract()
 
         # making all jumps black
-        for line in soup.select("line"):
+        for line in elements["line"]:
             line["class"] = "j"
 
         # the marker we use for marking a selected system
@@ -283,6 +364,7 @@ class Map(object):
             line = soup.new_tag("line", x1=coord[0], y1=coord[1], x2="0", y2="0", style="stroke:#462CFF")
             group.append(line)
         svg.insert(0, group)
+        elements["#select_marker"] = group
 
         # marker for jumpbridges
         for jb_color in JB_COLORS:
@@ -303,7 +385,7 @@ class Map(object):
             endmarker.append(endpath)
             svg.insert(0, endmarker)
 
-        jumps = soup.select("#jumps")[0]
+        jumps = elements["#jumps"]
         for systemid, system in self.systems_by_id.items():
             coords = system.map_coordinates
             # stats = system.statistics
@@ -319,6 +401,172 @@ class Map(object):
             jumps.append(svgtext)
 
 
+class JumpDistances(object):
+    """ The distances in jumps between the systems of a map.
+        For every system we keep all systems it can reach ordered by their
+        distance, so "all systems within n jumps" is a slice of this list.
+        The list of a system is found by one BFS, the first time we need it
+        or for all systems in precompute()."""
+
+    def __init__(self, systems, neighbours=None):
+        """ systems = the systems of the map
+            neighbours = dict system: set of its neighbours, without it
+                         we use the _neighbours of the systems"""
+        self.systems = list(systems)
+        self.neighbours = neighbours
+        self.router = None  # the Router which uses us, set by the Router
+        self._rows = {}  # system: (systems ordered by distance, distances, bounds)
+        if neighbours is None:
+            for system in self.systems:
+                system._distances = self
+
+    def precompute(self):
+        for system in self.systems:
+            self._row(system)
+
+    def clear(self):
+        """ The neighbours changed, everything must be computed again"""
+        self._rows = {}
+        if self.router is not None:
+            self.router.clear()
+
+    def _row(self, source):
+        row = self._rows.get(source)
+        if row is None:
+            ordered = [source]
+            distances = {source: 0}
+            bounds = []  # bounds[n] = number of systems within n jumps
+            frontier = [source]
+            while frontier:
+                bounds.append(len(ordered))
+                distance = len(bounds)
+                next_frontier = []
+                for system in frontier:
+                    if self.neighbours is None:
+                        neighbours = system._neighbours
+                    else:
+                        neighbours = self.neighbours.get(system, ())
+                    for neighbour in neighbours:
+                        if neighbour not in distances:
+                            distances[neighbour] = distance
+                            ordered.append(neighbour)
+                            next_frontier.append(neighbour)
+                frontier = next_frontier
+            row = (ordered, distances, bounds)
+            self._rows[source] = row
+        return row
+
+    def within(self, source, distance):
+        """ Returns a list of all systems within distance jumps of source
+            (incl. source), ordered by distance"""
+        ordered, _, bounds = self._row(source)
+        if distance < len(bounds):
+            return ordered[:bounds[distance]]
+        return list(ordered)
+
+    def distance(self, source, target):
+        """ Returns the distance in jumps, None if there is no way"""
+        return self._row(source)[1].get(target)
+
+    def distances_from(self, source):
+        """ Returns a dict system: distance of all systems source reaches"""
+        return self._row(source)[1]
+
+
+class Router(object):
+    """ The shortest ways between the systems of a map, over the gates and
+        if wanted also over the jumpbridges. A jumpbridge is used in the
+        direction(s) of its linetype: "<->" both ways, "->" only from the
+        first system to the second, "<-" only back.
+        The result of Dijkstra for a source is kept until the jumpbridges
+        (or the gates) change, version counts these changes."""
+
+    # the cost of a jump through a gate and through a jumpbridge
+    GATE_WEIGHT = 1
+    BRIDGE_WEIGHT = 1
+
+    def __init__(self, systems, distances=None):
+        """ systems = the systems of the map
+            distances = the JumpDistances of the map, used for the ways
+                        without jumpbridges"""
+        self.systems = list(systems)
+        self.distances = distances
+        if distances is not None:
+            distances.router = self
+        self.bridges = {}  # system: set of systems we can bridge to
+        self.version = 0
+        self._results = {}  # (source, with_bridges): (costs, previous systems)
+
+    def set_jumpbridges(self, jumpbridges):
+        """ jumpbridges = tuples (system, linetype, system), replaces all
+                          jumpbridges we had"""
+        bridges = {}
+        for start, linetype, stop in jumpbridges:
+            both = "<" not in linetype and ">" not in linetype
+            if ">" in linetype or both:
+                bridges.setdefault(start, set()).add(stop)
+            if "<" in linetype or both:
+                bridges.setdefault(stop, set()).add(start)
+        self.bridges = bridges
+        self.clear()
+
+    def clear(self):
+        self.version += 1
+        self._results = {}
+
+    def _dijkstra(self, source, with_bridges):
+        key = (source, with_bridges)
+        result = self._results.get(key)
+        if result is None:
+            costs = {source: 0}
+            previous = {source: None}
+            counter = itertools.count()  # systems are not comparable
+            queue = [(0, next(counter), source)]
+            while queue:
+                cost, _, system = heapq.heappop(queue)
+                if cost > costs[system]:
+                    continue
+                ways = [(neighbour, self.GATE_WEIGHT) for neighbour in system._neighbours]
+                if with_bridges:
+                    ways.extend((other, self.BRIDGE_WEIGHT) for other in self.bridges.get(system, ()))
+                for other, weight in ways:
+                    new_cost = cost + weight
+                    if new_cost < costs.get(other, new_cost + 1):
+                        costs[other] = new_cost
+                        previous[other] = system
+                        heapq.heappush(queue, (new_cost, next(counter), other))
+            result = (costs, previous)
+            self._results[key] = result
+        return result
+
+    def route(self, source, target, with_bridges=True):
+        """ Returns the systems on the shortest way from source to target
+            (incl. both), None if there is no way"""
+        costs, previous = self._dijkstra(source, with_bridges)
+        if target not in costs:
+            return None
+        route = [target]
+        while route[-1] is not source:
+            route.append(previous[route[-1]])
+        route.reverse()
+        return route
+
+    def distance(self, source, target, with_bridges=True):
+        """ Returns the cost of the shortest way, None if there is no way"""
+        if not with_bridges and self.distances is not None:
+            return self.distances.distance(source, target)
+        return self._dijkstra(source, with_bridges)[0].get(target)
+
+    def within(self, source, distance, with_bridges=True):
+        """ Returns a dict system: cost of all systems which cost at most
+            distance from source"""
+        if not with_bridges and self.distances is not None:
+            distances = self.distances.distances_from(source)
+            return {system: distances[system] for system in self.distances.within(source, distance)}
+        costs = self._dijkstra(source, with_bridges)[0]
+        return {system: cost for system, cost in costs.items() if cost <= distance}
+
+
 class System(object):
     # sig_status_changed = pyqtSignal(str, str)
     """ A System in the Map """
@@ -334,24 +582,37 @@ class System(object):
     UNKNOWN_COLOR = "#FFFFFF"
     CLEAR_COLOR   = "#59FF6C"
 
+    # the messages we keep for a system: the last MAX_MESSAGES, not older
+    # than MAX_MESSAGE_AGE seconds
+    MAX_MESSAGES = 50
+    MAX_MESSAGE_AGE = 60*60*24
+
     def __init__(self, name, svg_element, mapsoup, map_coordinates, systemid):
         self.status      = states.UNKNOWN
         self.name        = name
         self.svg_element = svg_element
         self.mapsoup     = mapsoup
         self.orig_slvg_element = svg_element
-        self.rect        = svg_element.select("rect")[0]
-        self.second_line = svg_element.select("text")[1]
+        self.rect        = svg_element.find("rect")
+        self.second_line = svg_element.find_all("text", limit=2)[1]
         self.last_alarm_time   = 0
-        self.messages    = []
+        self.messages    = collections.deque(maxlen=self.MAX_MESSAGES)
         # self.set_status(states.UNKNOWN)
         self.__located_characters = []
         self.background_color = "#FFFFFF"
         self.map_coordinates  = map_coordinates
         self.systemid         = systemid
         self._neighbours      = set()
+        self._distances       = None  # the JumpDistances of the map
         self.statistics       = {"jumps": "?", "shipkills": "?", "factionkills": "?", "podkills": "?"}
 
+    def add_message(self, message):
+        """ Adds a message about the system and forgets the old ones"""
+        self.messages.append(message)
+        oldest = message.timestamp - datetime.timedelta(seconds=self.MAX_MESSAGE_AGE)
+        while self.messages[0].timestamp < oldest:
+            self.messages.popleft()
+
     def set_jumpbridge_color(self, color):
         log.debug(self.name)
 
@@ -430,10 +691,11 @@ class System(object):
            neighbour_system: a system (not a system's name!)"""
         self._neighbours.add(neighbour_system)
         neighbour_system._neighbours.add(self)
+        for distances in (self._distances, neighbour_system._distances):
+            if distances is not None:
+                distances.clear()
 
     def get_neighbours(self, distance=1):
-        log.debug(self.name)
-
         """ Get all neigboured system with a distance of distance.
             example: sys1 <-> sys2 <-> sys3 <-> sys4 <-> sys5
                      sys3(distance=1) will find sys2, sys3, sys4
@@ -442,19 +704,10 @@ class System(object):
                     as key and a dict as value. key "distance" contains the
                     distance. for first example:
                               {sys3: {"distance"}: 0, sys2: {"distance"}: 1}"""
-        # neighbours = []
-        systems = {self: {"distance": 0}}
-        current_distance = 0
-        while current_distance < distance:
-            current_distance += 1
-            new_systems = []
-            for system in systems.keys():
-                for neighbour in system._neighbours:
-                    if neighbour not in systems:
-                        new_systems.append(neighbour)
-            for new_system in new_systems:
-                systems[new_system] = {"distance": current_distance}
-        return systems
+        if self._distances is None:
+            JumpDistances([self])
+        distances = self._distances.distances_from(self)
+        return {system: {"distance": distances[system]} for system in self._distances.within(self, distance)}
 
     def remove_neighbour(self, system):
         log.debug(self.name)
@@ -463,7 +716,10 @@ class System(object):
         if system in self._neighbours:
             self._neighbours.remove(system)
         if self in system._neighbours:
-            system._neigbours.remove(self)
+            system._neighbours.remove(self)
+        for distances in (self._distances, system._distances):
+            if distances is not None:
+                distances.clear()
         
     def set_status(self, new_status):
         log.debug(self.name)
@@ -543,6 +799,131 @@ class System(object):
             self.second_line.string = string
 
 
+class Universe(object):
+    """ The gates of several regions as one graph, so we know the distances
+        across the borders of a region. Only the graph is read from the
+        SVGs of the regions (no soup, no System objects), the systems are
+        known by their names.
+        The map of a region contains the systems of the other regions it
+        has gates to, so the regions are stitched together by these
+        shared system ids."""
+
+    SVG_NS = "{http://www.w3.org/2000/svg}"
+    XLINK_HREF = "{http://www.w3.org/1999/xlink}href"
+    # how many SVGs we get from the cache or from dotlan at the same time
+    MAX_DOWNLOADS = 4
+
+    def __init__(self, regions, svgs=None):
+        """ regions = the names of the regions as dotlan uses them
+            svgs = dict regionname: svg, the others come from the cache
+                   or from dotlan"""
+        self.regions = set()
+        self.names = {}          # systemid: systemname
+        self.ids = {}            # systemname: systemid
+        self.region_of = {}      # systemname: regionname
+        self.neighbours = {}     # systemname: set of systemnames
+        self.distances = JumpDistances((), self.neighbours)
+        self.add_regions(regions, svgs)
+
+    @classmethod
+    def around(cls, region, svgs=None):
+        """ The universe of region and all regions it has gates to"""
+        svgs = dict(svgs or {})
+        if region not in svgs:
+            svgs[region] = get_region_svg(region)
+        universe = cls([region], svgs)
+        universe.add_regions(universe.adjacent_regions(region), svgs)
+        return universe
+
+    def add_regions(self, regions, svgs=None):
+        regions = [region for region in regions if region not in self.regions]
+        svgs = svgs or {}
+        missing = [region for region in regions if not svgs.get(region)]
+        with ThreadPoolExecutor(max_workers=self.MAX_DOWNLOADS) as executor:
+            loaded = dict(zip(missing, executor.map(self._get_svg, missing)))
+        for region in regions:
+            svg = svgs.get(region) or loaded[region]
+            if svg:
+                self._add_svg(region, svg)
+        self.distances.clear()
+
+    @staticmethod
+    def _get_svg(region):
+        """ The SVG of the region, None if we can't get it. A region we
+            don't know is only missing in the graph"""
+        try:
+            return get_region_svg(region)
+        except Exception as e:
+            log.warning("can't get the map of {0}: {1}".format(region, str(e)))
+            return None
+
+    def adjacent_regions(self, region):
+        """ Returns the names of the regions the region has gates to"""
+        regions = set()
+        for name, other_region in self.region_of.items():
+            if other_region != region and any(self.region_of.get(n) == region for n in self.neighbours[name]):
+                regions.add(other_region)
+        return regions
+
+    def _add_svg(self, region, svg):
+        self.regions.add(region)
+        root = ElementTree.fromstring(svg)
+        jumps = []
+        for element in root.iter():
+            tag = element.tag
+            if tag == self.SVG_NS + "symbol":
+                symbolid = element.get("id", "")
+                systemid = symbolid[3:]
+                if not (symbolid.startswith("def") and systemid.isdigit()):
+                    continue
+                for a in element.iter(self.SVG_NS + "a"):
+                    if not a.get("class", "").startswith("sys "):
+                        continue
+                    text = a.find(self.SVG_NS + "text")
+                    name = text.text.strip().upper()
+                    self.names[systemid] = name
+                    self.ids[name] = systemid
+                    self.neighbours.setdefault(name, set())
+                    # a system of another region links to the map of its region
+                    href = a.get(self.XLINK_HREF, "")
+                    if "/map/" in href:
+                        self.region_of.setdefault(name, href.split("/map/")[1].split("/")[0])
+                    else:
+                        self.region_of[name] = region
+                    break
+            elif tag == self.SVG_NS + "line":
+                parts = element.get("id", "").split("-")
+                if len(parts) == 3 and parts[0] == "j":
+                    jumps.append(parts)
+        for _, start, stop in jumps:
+            if start in self.names and stop in self.names:
+                start, stop = self.names[start], self.names[stop]
+                self.neighbours[start].add(stop)
+                self.neighbours[stop].add(start)
+
+    def within(self, systemname, distance):
+        """ Returns a dict systemname: distance of all systems within
+            distance jumps"""
+        distances = self.distances.distances_from(systemname)
+        return {name: distances[name] for name in self.distances.within(systemname, distance)}
+
+    def distance(self, systemname, other_systemname):
+        """ Returns the distance in jumps, None if there is no way"""
+        return self.distances.distance(systemname, other_systemname)
+
+
+def get_region_svg(region):
+    """ Returns the SVG of the region from the cache or from dotlan"""
+    cache = Cache()
+    svg = cache.get_from_cache("map_" + region)
+    if not svg:
+        req = requests.get(Map.DOTLAN_BASIC_URL.format(region))
+        req.raise_for_status()
+        svg = req.text
+        cache.put_into_cache("map_" + region, svg, vi.evegate.seconds_till_downtime() + 60*60)
+    return svg
+
+
 def convert_regionname(name):
     """ Converts a (system)name to the format that dotland uses """
     converted = []
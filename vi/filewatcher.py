@@ -17,9 +17,10 @@
 #  along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
 ###########################################################################
 
-import os, re, time
 from PyQt5.QtCore import QThread, QFileSystemWatcher, pyqtSignal
 
+from vi.chatlogs import ChatlogWatcher
+
 """
 There is a problem with the QFIleWatcher on Windows and the log
 files from EVE.
@@ -30,72 +31,45 @@ reread the files informations, trigger the QFileWatcher.
 So here is a workaround implementation.
 We use here also a QFileWatcher, only to the directory. It will notify it
 if a new file was created. We watch only the newest (last 24h), not all!
+The work itself is done by vi.chatlogs.ChatlogWatcher. With the inotify
+backend it gets the directory events itself, the QFileWatcher is only
+needed for polling.
 """
 
 
 class FileWatcher(QThread):
-    fchange = pyqtSignal(str, str)
+    # all changes found at once: list of tuples (path, roomname, new lines)
+    fchanges = pyqtSignal(object)
 
-    def __init__(self, path, max_age):
+    def __init__(self, path, max_age, backend=None, rooms=None):
         QThread.__init__(self)
         self.path = path
         self.max_age = max_age
-        self.files = {}
-        self.file_reg = re.compile('(.+)_\d{8}_\d{6}' + re.escape(os.path.extsep) + 'txt$', re.IGNORECASE)
-        self.qtfw = QFileSystemWatcher()
-        self.qtfw.directoryChanged.connect(self.directory_changed)
-        self.qtfw.addPath(path)
-        self.update_watched_files(path)
-
-    def directory_changed(self, path):
-        self.update_watched_files(path)
+        self.watcher = ChatlogWatcher(path, max_age, backend, rooms=rooms)
+        self.backend = self.watcher.backend
+        if self.backend == ChatlogWatcher.POLLING:
+            self.qtfw = QFileSystemWatcher()
+            self.qtfw.directoryChanged.connect(self.directory_changed)
+            self.qtfw.addPath(path)
 
-    def run(self):
-        while True:
-            for path, modified in self.files.items():
-                new_modified = 0
-                try:
-                    new_modified = os.path.getsize(path)
-                except Exception as e:
-                    print('filewatcher-thread error:', path, str(e))
-                if new_modified > modified:
-                    chatname = None
-                    test = self.file_reg.search(os.path.basename(path))
-                    if test:
-                        chatname = test.group(1)
-                    self.fchange.emit(path, chatname)
-                    self.files[path] = new_modified
-            time.sleep(1)
+    @property
+    def files(self):
+        return self.watcher.files
 
-    def update_watched_files(self, changed_path):
-        # reeading all files from the directory
-        now = time.time()
-        path = self.path
-        files_in_dir = set()
+    @property
+    def index(self):
+        return self.watcher.index
 
-        for f in os.listdir(path):
-            if not os.path.isdir(f):
-                full_path = ''
-                try:
-                    add = True
-                    full_path = os.path.join(path, f)
-                    if self.max_age and now - os.path.getmtime(full_path) > self.max_age:
-                        add = False
-                    if add:
-                        files_in_dir.add(full_path)
-                except Exception as e:
-                    print("file to filewatcher failed:", full_path, str(e))
+    @property
+    def rooms(self):
+        return self.watcher.rooms
 
-        # are there old file, that not longer exists?
-        files_to_remove = set()
-        for known_file in self.files:
-            if known_file not in files_in_dir:
-                files_to_remove.add(known_file)
+    @rooms.setter
+    def rooms(self, rooms):
+        self.watcher.rooms = rooms
 
-        for file_to_remove in files_to_remove:
-            del self.files[file_to_remove]
+    def directory_changed(self, path):
+        self.watcher.update_watched_files()
 
-        # are there new files we must watch now?
-        for new_file in files_in_dir:
-            if new_file not in self.files:
-                self.files[new_file] = os.path.getsize(new_file)
+    def run(self):
+        self.watcher.run(self.fchanges.emit)
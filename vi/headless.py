@@ -0,0 +1,231 @@
+###########################################################################
+#  Vintel - Visual Intel Chat Analyzer                                    #
+#  Copyright (C) 2014-15 Sebastian Meyer (sparrow.242.de+eve@gmail.com )  #
+#                                                                         #
+#  This program is free software: you can redistribute it and/or modify   #
+#  it under the terms of the GNU General Public License as published by   #
+#  the Free Software Foundation, either version 3 of the License, or      #
+#  (at your option) any later version.                                    #
+#                                                                         #
+#  This program is distributed in the hope that it will be useful,        #
+#  but WITHOUT ANY WARRANTY; without even the implied warranty of         #
+#  MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the          #
+#  GNU General Public License for more details.                           #
+#                                                                         #
+#                                                                         #
+#  You should have received a copy of the GNU General Public License      #
+#  along with this program.  If not, see <http://www.gnu.org/licenses/>.  #
+###########################################################################
+
+""" Vintel without a GUI: the filewatcher, the chatparser and the map, but
+    no Qt. Everything we find is written as one JSON object per line
+    (newline delimited JSON) to stdout or to everyone who connects to a
+    TCP port:
+
+        {"type": "message", "time": "2015-02-12T18:03:21", "room": ...,
+         "user": ..., "text": ..., "status": "alarm", "systems": [...]}
+        {"type": "status_change", "time": ..., "system": ..., "status": ...}
+        {"type": "location", "time": ..., "char": ..., "system": ...}
+
+    Nothing here (and nothing imported from here) may import PyQt5.
+"""
+
+import argparse
+import json
+import logging
+import os
+import socket
+import sys
+import threading
+
+from vi import dotlan, states
+from vi.cache.cache import Cache
+from vi.chatlogs import ChatlogWatcher, PollScheduler, find_chatlog_dir
+from vi.chatparser.chatparser import ChatParser
+from vi.chatparser.stream import MessageStream
+from vi.resources import resource_path
+
+log = logging.getLogger(__name__)
+log.setLevel(logging.DEBUG)
+
+# the filewatcher looks only at files modified in the last MAX_AGE seconds
+MAX_AGE = 60*60*24
+# seconds between two scans of the directory for new files (polling)
+RESCAN_INTERVAL = 5
+
+# how many records may wait for a client of the TCP port, a slower one
+# loses the oldest
+CLIENT_QUEUE_SIZE = 10000
+
+
+class IntelMap(object):
+    """ The state of the map for the daemon. Gets the parsed messages in
+        the order the chatparser found them, keeps the map up to date (the
+        locations of the chars and the status of the systems) and returns
+        the records of the messages. A status_change is only written if the
+        status of the system really changed."""
+
+    def __init__(self, dotlan_map):
+        self.dotlan_map = dotlan_map
+
+    def records(self, messages):
+        """ Returns the list of records (dicts) for a batch of messages"""
+        result = []
+        for message in messages:
+            try:
+                result.extend(self._records(message))
+            except Exception as e:
+                # a message we can't handle must not stop the others
+                log.error("can't handle the message %r: %s", message.plain_text, e)
+        return result
+
+    def _records(self, message):
+        time = message.timestamp.isoformat()
+        if message.status == states.LOCATION:
+            systemname = message.systems[0]
+            self.dotlan_map.set_character_location(message.user, systemname)
+            return [{"type": "location", "time": time, "char": message.user, "system": systemname}]
+        if message.status in (states.IGNORE, states.KOS_STATUS_REQUEST, states.SOUNDTEST):
+            return []
+        if message.user in ("EVE-System", "EVE System"):
+            return []
+        systems = sorted(message.systems, key=lambda system: system.name)
+        result = [{"type": "message", "time": time, "room": message.room, "user": message.user,
+                   "text": message.plain_text, "status": message.status,
+                   "systems": [system.name for system in systems]}]
+        if message.status in (states.ALARM, states.CLEAR):
+            for system in systems:
+                changed = system.status != message.status
+                # an alarm again is no change, but restarts the clock of the system
+                system.set_status(message.status)
+                if changed:
+                    result.append({"type": "status_change", "time": time, "system": system.name,
+                                   "status": message.status})
+        return result
+
+
+def write_records(subscription, write):
+    """ Writes all records of the subscription as lines of JSON with
+        write(line). Returns when the subscription is closed or write
+        fails."""
+    try:
+        for record in subscription:
+            try:
+                line = json.dumps(record) + "\n"
+            except (TypeError, ValueError) as e:
+                log.error("can't write the record %r: %s", record, e)
+                continue
+            try:
+                write(line)
+            except (OSError, ValueError) as e:
+                log.info("output closed: %s", e)
+                return
+    finally:
+        # never leave a full subscription behind, it would block the
+        # publisher (and with it the filewatcher)
+        subscription.close()
+
+
+def write_to_stdout(stream):
+    subscription = stream.subscribe()
+
+    def write(line):
+        sys.stdout.write(line)
+        sys.stdout.flush()
+
+    thread = threading.Thread(target=write_records, args=(subscription, write), daemon=True)
+    thread.start()
+
+
+def serve(stream, host, port):
+    """ Accepts clients on host:port, every client gets the records from
+        the moment it connected"""
+    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind((host, port))
+    server.listen(5)
+    log.info("listening on %s:%d", host, port)
+
+    def client(connection, address):
+        log.info("client connected: %s", address)
+        # a slow client must never stop the parser
+        subscription = stream.subscribe(CLIENT_QUEUE_SIZE, block=False)
+        with connection:
+            write_records(subscription, lambda line: connection.sendall(line.encode("utf-8")))
+        log.info("client disconnected: %s", address)
+
+    def accept():
+        while True:
+            connection, address = server.accept()
+            threading.Thread(target=client, args=(connection, address), daemon=True).start()
+
+    threading.Thread(target=accept, daemon=True).start()
+
+
+def load_map(regionname):
+    """ Returns the dotlan.Map of the region, the local one if we have it"""
+    svg = None
+    try:
+        with open(resource_path("vi/ui/res/mapdata/{0}.svg".format(regionname))) as svg_file:
+            svg = svg_file.read()
+    except Exception:
+        pass
+    return dotlan.Map(regionname, svg)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vintel without GUI, writes the intel as JSON lines")
+    parser.add_argument("logdir", nargs="?", help="the directory with the chatlogs")
+    parser.add_argument("--rooms", help="the intel channels, separated by comma "
+                                        "(default: the rooms Vintel watches)")
+    parser.add_argument("--region", help="the region of the map (default: the one of Vintel)")
+    parser.add_argument("--listen", metavar="[HOST:]PORT",
+                        help="write to the clients of this TCP port, not to stdout")
+    parser.add_argument("--backend", choices=(ChatlogWatcher.AUTO, ChatlogWatcher.INOTIFY, ChatlogWatcher.POLLING),
+                        help="how to watch the chatlogs")
+    parser.add_argument("--max-poll-interval", type=float, default=PollScheduler.MAX_INTERVAL, metavar="SECONDS",
+                        help="when polling, the longest wait for new lines in the intel channels "
+                             "(default: %(default)s)")
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr,
+                        format='%(asctime)-15s %(name)s: %(message)s')
+
+    path_to_logs = find_chatlog_dir(args.logdir)
+    if path_to_logs is None:
+        sys.exit("Vintel could not find the directory where the EvE chatlogs are stored.")
+
+    # the same data directory (and so the same settings) as the GUI
+    datadir = os.path.join(os.path.dirname(os.path.dirname(path_to_logs)), "vintel")
+    if not os.path.exists(datadir):
+        os.mkdir(datadir)
+    Cache.PATH_TO_CACHE = os.path.join(datadir, "cache.sqlite3")
+    cache = Cache()
+
+    if args.rooms:
+        rooms = [room.strip() for room in args.rooms.split(",")]
+    else:
+        rooms = (cache.get_from_cache("roomnames") or "TheCitadel,North Provi Intel").split(",")
+    regionname = args.region or cache.get_from_cache("regionname") or "Providence"
+
+    try:
+        dotlan_map = load_map(dotlan.convert_regionname(regionname))
+    except dotlan.DotlanException as e:
+        sys.exit(str(e))
+
+    watcher = ChatlogWatcher(path_to_logs, MAX_AGE, args.backend, rescan_interval=RESCAN_INTERVAL, rooms=rooms,
+                             max_interval=args.max_poll_interval)
+    chatparser = ChatParser(path_to_logs, rooms, dotlan_map.systems, watcher.index)
+
+    stream = MessageStream()
+    if args.listen:
+        host, _, port = args.listen.rpartition(":")
+        serve(stream, host or "127.0.0.1", int(port))
+    else:
+        write_to_stdout(stream)
+    try:
+        stream.watch(watcher, chatparser, IntelMap(dotlan_map).records)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stream.close()
@@ -154,7 +154,9 @@ window.chan = new QWebChannel(qt.webChannelTransport, function(channel) {
 
                 let $elm = $('#def' + obj.sysid);
                 if ($elm.length > 0) {
-                    $elm.attr('data-last-alarm', now);
+                    // replayed intel brings the time it was reported
+                    let time_alarm = (obj.time !== undefined) ? Math.min(obj.time, now) : now;
+                    $elm.attr('data-last-alarm', time_alarm);
                     $elm.attr('data-last-status', obj.status);
 
                     $elm.addClass('stopwatch');
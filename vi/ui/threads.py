@@ -24,9 +24,12 @@ from queue import Queue
 import time
 import logging
 
+from vi import dotlan
 from vi import evegate
 from vi import koschecker
 from vi.cache.cache import Cache
+from vi.chatparser import backlog
+from vi.chatparser.stream import MessageStream
 
 from vi.resources import resource_path
 
@@ -137,6 +140,85 @@ class KOSCheckerThread(QThread):
             self.kos_result.emit(state, text, request_type, has_kos)
 
 
+class ChatParserThread(QThread):
+    """ Runs the ChatParser, so reading and parsing the logs never blocks
+        the GUI. The parsed messages are published to stream, everyone who
+        wants them subscribes there (see MessageStreamThread for the GUI).
+        If catch_up_minutes is set, the thread parses the intel of the last
+        minutes first (in a process pool, see backlog.catch_up) and sends
+        it with messages_replayed."""
+    messages_replayed = pyqtSignal(object)
+
+    # warn if more batches than this are waiting
+    MAX_QUEUE_DEPTH = 10
+
+    def __init__(self, chatparser):
+        QThread.__init__(self)
+        self.chatparser = chatparser
+        self.q = Queue()
+        self.last_processing_time = 0.0     # seconds for the last batch
+        self.average_processing_time = 0.0  # moving average in seconds
+        self.catch_up_minutes = 0
+        self.stream = MessageStream()
+
+    @property
+    def queue_depth(self):
+        """ the number of batches waiting to be parsed"""
+        return self.q.qsize()
+
+    def add_changes(self, changes):
+        """ changes = list of tuples (path, roomname, new lines), as
+            delivered by the FileWatcher"""
+        self.q.put(changes)
+
+    def run(self):
+        if self.catch_up_minutes:
+            # the changes of the filewatcher wait in the queue meanwhile
+            try:
+                messages = backlog.catch_up(self.chatparser, self.catch_up_minutes)
+                if messages:
+                    self.messages_replayed.emit(messages)
+            except Exception as e:
+                print("An error while catching up on the intel:", str(e))
+        while True:
+            changes = self.q.get()
+            start = time.time()
+            try:
+                messages = self.chatparser.files_changed(changes)
+            except Exception as e:
+                print("An error in the chatparser-thread:", str(e))
+                continue
+            self.last_processing_time = time.time() - start
+            self.average_processing_time = 0.9 * self.average_processing_time + 0.1 * self.last_processing_time
+            depth = self.queue_depth
+            if depth > self.MAX_QUEUE_DEPTH:
+                logging.warning('chatparser falls behind: {0} batches waiting, last batch {1:.3f}s'.format(
+                    depth, self.last_processing_time))
+            if messages:
+                self.stream.publish(messages)
+
+
+class MessageStreamThread(QThread):
+    """ A subscriber of a MessageStream for the GUI: waits for the messages
+        and sends all which are there in one messages_received."""
+    messages_received = pyqtSignal(object)
+
+    # how many messages may wait for the GUI, before the parser has to wait
+    MAX_WAITING = 10000
+
+    def __init__(self, stream):
+        QThread.__init__(self)
+        self.subscription = stream.subscribe(self.MAX_WAITING)
+
+    def run(self):
+        while True:
+            try:
+                messages = self.subscription.get_batch()
+            except StopIteration:
+                return
+            self.messages_received.emit(messages)
+
+
 class MapStatisticsThread(QThread):
     statistic_data_update = pyqtSignal(object)
 
@@ -154,3 +236,21 @@ class MapStatisticsThread(QThread):
             retdata = {"result": "error", "text": str(e)}
             # self.statistic_data_update.emit(retdata)
             self.statistic_data_update.emit(retdata)
+
+
+class UniverseThread(QThread):
+    """ Loads the regions around the map (from the cache or from dotlan),
+        so the alarm distance counts the jumps across the borders too"""
+    universe_loaded = pyqtSignal(object)
+
+    def __init__(self, region, svg):
+        QThread.__init__(self)
+        self.region = region
+        self.svg = svg
+
+    def run(self):
+        try:
+            universe = dotlan.Universe.around(self.region, {self.region: self.svg})
+            self.universe_loaded.emit(universe)
+        except Exception as e:
+            logging.warning("loading the regions around {0} failed: {1}".format(self.region, str(e)))
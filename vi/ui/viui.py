@@ -18,6 +18,7 @@
 ###########################################################################
 
 import base64
+import calendar
 import datetime
 import json
 import logging
@@ -44,7 +45,7 @@ from vi.cache.cache import Cache
 from vi.chatparser.chatparser import ChatParser
 from vi.resources import resource_path
 from vi.ui.systemtray import TrayContextMenu
-from vi.ui.threads import AvatarFindThread, KOSCheckerThread
+from vi.ui.threads import AvatarFindThread, ChatParserThread, KOSCheckerThread, MessageStreamThread, UniverseThread
 
 VERSION = vi.version.VERSION
 DEBUG = True
@@ -56,6 +57,9 @@ class MainWindow(QMainWindow):
     sig_chatmessage_added = pyqtSignal(object)
     sig_avatar_loaded     = pyqtSignal(str, object)
 
+    # how much intel we read on start, if action_catch_up is checked
+    CATCH_UP_MINUTES = 15
+
     def __init__(self, path_to_logs, trayicon):
         """ systems = list of system-objects creted by dotlan.py
         """
@@ -95,6 +99,11 @@ class MainWindow(QMainWindow):
                 .format(type(e), str(e))
             QMessageBox.warning(None, "Using map from my cache", diatext, QMessageBox.Ok)
 
+        # the alarm distance over the borders of the region needs the regions around
+        self.universe_thread = UniverseThread(self.dotlan.region, self.dotlan.svg_clean)
+        self.universe_thread.universe_loaded.connect(self.universe_loaded)
+        self.universe_thread.start()
+
         jumpbridge_url = c.get_from_cache("jumpbridge_url")
         self.set_jumpbridges(jumpbridge_url)
         self.init_map_position = None  # we read this after first rendering
@@ -160,10 +169,8 @@ class MainWindow(QMainWindow):
         # http://stackoverflow.com/questions/40747827/qwebenginepage-disable-links
         # end map =============================================================
 
+        # the filewatcher is started when the chatparser is ready
         self.filewatcher_thread = filewatcher.FileWatcher(self.path_to_logs, 60*60*24)
-        # self.connect(self.filewatcher_thread, QtCore.SIGNAL("fchange"), self.logfile_changed)
-        self.filewatcher_thread.fchange.connect(self.logfile_changed)
-        self.filewatcher_thread.start()
 
         if False:
             self.last_statistics_update = 0
@@ -240,7 +247,25 @@ class MainWindow(QMainWindow):
         self.actionQuit.triggered.connect(self.close)
         self.trayicon.sig_quit.connect(self.close)
 
-        self.chatparser = ChatParser(self.path_to_logs, roomnames, self.dotlan.systems)
+        self.chatparser = ChatParser(self.path_to_logs, roomnames, self.dotlan.systems,
+                                     self.filewatcher_thread.index)
+        # the intel channels are polled fast, the other logs may wait
+        self.filewatcher_thread.rooms = roomnames
+
+        # parsing is done in its own thread, we only render the messages
+        self.chatparser_thread = ChatParserThread(self.chatparser)
+        # the GUI is one of the subscribers of the parsed messages
+        self.message_stream_thread = MessageStreamThread(self.chatparser_thread.stream)
+        self.message_stream_thread.messages_received.connect(self.chat_messages_parsed)
+        self.message_stream_thread.start()
+        self.chatparser_thread.messages_replayed.connect(self.chat_messages_replayed)
+        if self.action_catch_up.isChecked():
+            self.chatparser_thread.catch_up_minutes = self.CATCH_UP_MINUTES
+        self.chatparser_thread.start()
+        # self.connect(self.filewatcher_thread, QtCore.SIGNAL("fchange"), self.logfile_changed)
+        # the changes go directly from the filewatcher- to the parser-thread
+        self.filewatcher_thread.fchanges.connect(self.chatparser_thread.add_changes, QtCore.Qt.DirectConnection)
+        self.filewatcher_thread.start()
 
         version_check_thread = drachenjaeger.NotifyNewVersionThread()
         version_check_thread.newer_version.connect(self.notify_newer_version)
@@ -262,6 +287,12 @@ class MainWindow(QMainWindow):
 
     def update_evetime(self):
         self.evetime_label.setText(datetime.datetime.utcnow().strftime('Current EVE Time: %X'))
+        parser = self.chatparser_thread
+        cache_info = self.chatparser.parse_cache_info()
+        self.evetime_label.setToolTip("Chatparser: {0} batches waiting, last batch {1:.1f}ms, average {2:.1f}ms, "
+                                      "{3} of {4} texts from the cache".format(
+            parser.queue_depth, parser.last_processing_time * 1000, parser.average_processing_time * 1000,
+            cache_info.hits, cache_info.hits + cache_info.misses))
 
     def notify_newer_version(self, newest_version):
         self.trayicon.showMessage("Newer Version", 
@@ -308,23 +339,32 @@ class MainWindow(QMainWindow):
             sound.sound_active = self.actionActivate_Sound.isChecked()
         
     def add_message_to_intelchat(self, message):
+        self.add_messages_to_intelchat([message])
+
+    def add_messages_to_intelchat(self, messages):
+        """ Adds all messages with one layout and repaint of the chat"""
         scroll_to_bottom = False
         if (self.chatListWidget.verticalScrollBar().value() == self.chatListWidget.verticalScrollBar().maximum()):
             scroll_to_bottom = True
 
-        entry = ChatEntry(message)
-        listWidgetItem = QtWidgets.QListWidgetItem(self.chatListWidget)
-        listWidgetItem.setSizeHint(entry.sizeHint())
-        self.chatListWidget.addItem(listWidgetItem)
-        self.chatListWidget.setItemWidget(listWidgetItem, entry)
-        if ChatEntry.SHOW_AVATAR:
-            # log.debug('requesting "{0}" avatar'.format(entry.message.user))
-            self.avatar_find_thread.add_chatentry(entry)
-        # else:
-            # log.debug('requesting "{0}" avatar disabled in options'.format(entry.message.user))
-        self.chatentries.append(entry)
-        entry.mark_system.connect(self.mark_system_on_map)
-        self.sig_chatmessage_added.emit(entry)
+        self.chatListWidget.setUpdatesEnabled(False)
+        try:
+            for message in messages:
+                entry = ChatEntry(message)
+                listWidgetItem = QtWidgets.QListWidgetItem(self.chatListWidget)
+                listWidgetItem.setSizeHint(entry.sizeHint())
+                self.chatListWidget.addItem(listWidgetItem)
+                self.chatListWidget.setItemWidget(listWidgetItem, entry)
+                if ChatEntry.SHOW_AVATAR:
+                    # log.debug('requesting "{0}" avatar'.format(entry.message.user))
+                    self.avatar_find_thread.add_chatentry(entry)
+                # else:
+                    # log.debug('requesting "{0}" avatar disabled in options'.format(entry.message.user))
+                self.chatentries.append(entry)
+                entry.mark_system.connect(self.mark_system_on_map)
+                self.sig_chatmessage_added.emit(entry)
+        finally:
+            self.chatListWidget.setUpdatesEnabled(True)
         if scroll_to_bottom:
             self.chatListWidget.scrollToBottom()
 
@@ -428,6 +468,8 @@ class MainWindow(QMainWindow):
             (None,                          "change_show_avatars",         self.actionShow_Chat_Avatars.isChecked()),
             (None,                          "change_alarm_distance",       self.alarm_distance),
             ("action_kos_clipboard_active", "setChecked",                  self.action_kos_clipboard_active.isChecked()),
+            ("action_catch_up",             "setChecked",                  self.action_catch_up.isChecked()),
+            ("action_alarm_over_jumpbridges", "setChecked",                self.action_alarm_over_jumpbridges.isChecked()),
             (None,                          "change_sound",                self.actionActivate_Sound.isChecked()),
             (None,                          "change_chat_visibility",      self.action_show_chat.isChecked()),
             ("map",                         "setZoomFactor",               self.map.zoomFactor()),
@@ -455,7 +497,11 @@ class MainWindow(QMainWindow):
         # self.dotlan.systems[str(systemname)].mark()
         # self.update_map()
 
+    def universe_loaded(self, universe):
+        self.dotlan.universe = universe
+
     def set_location(self, char, new_system):
+        self.dotlan.set_character_location(char, new_system)
         self.map.page().mark_player(char, new_system)
 
         """
@@ -532,8 +578,7 @@ class MainWindow(QMainWindow):
 
             text = text.replace("\n\n", "<br>")
             message = chatparser.chatparser.Message("Vintel KOS-Check", text, 
-                evegate.current_eve_time(), "VINTEL", [], states.NOT_CHANGE,
-                text.upper(), text)
+                evegate.current_eve_time(), "VINTEL", [], text, status=states.NOT_CHANGE)
 
             self.add_message_to_intelchat(message)
         elif state == "error":
@@ -543,6 +588,7 @@ class MainWindow(QMainWindow):
         cache = Cache()
         cache.put_into_cache("roomnames", u",".join(new_roomnames), 60*60*24*365*5)
         self.chatparser.rooms = new_roomnames
+        self.filewatcher_thread.rooms = new_roomnames
         
     def show_info(self):
         info_dialog = QDialog(self)
@@ -646,8 +692,16 @@ class MainWindow(QMainWindow):
     def zoomMapOut(self):
         self.map.setZoomFactor(self.map.zoomFactor() - 0.1)
 
-    def logfile_changed(self, path, roomname):
-        messages = self.chatparser.file_modified(path, roomname)
+    def chat_messages_replayed(self, messages):
+        """ messages = the intel of the last minutes before we started"""
+        self.chat_messages_parsed(messages, replay=True)
+
+    def chat_messages_parsed(self, messages, replay=False):
+        """ messages = all messages the chatparser-thread found in one batch
+            of changed logfiles
+            replay = the messages are old (catching up on start), so they
+                     only go to the chat and the map, no notifications"""
+        chat_messages = []
         for message in messages:
             # if players location changed
             if message.status == states.LOCATION:
@@ -667,12 +721,15 @@ class MainWindow(QMainWindow):
                 self.kos_request_thread.add_request(parts, "xxx", False)
             # if it is a 'normal' chat message
             elif message.user not in ("EVE-System", "EVE System") and message.status != states.IGNORE:
-                self.add_message_to_intelchat(message)
+                chat_messages.append(message)
 
                 if message.systems:
                     for system in message.systems:
                         systemname = system.name
                         # self.dotlan.set_system_status(systemname, message.status)
+                        if replay:
+                            self.map.page().set_system_status(system, message, message.timestamp)
+                            continue
                         self.map.page().set_system_status(system, message)
 
                         if message.status in (states.REQUEST, states.ALARM) \
@@ -682,13 +739,19 @@ class MainWindow(QMainWindow):
                             else:
                                 alarm_distance = 0
 
-                            for nsystem, data in system.get_neighbours(alarm_distance).items():
-                                distance = data["distance"]
-                                chars = nsystem.get_located_characters()
-                                if len(chars) > 0 and message.user not in chars:
+                            # all chars of one distance in one notification, the nearest first
+                            chars_by_distance = {}
+                            with_bridges = self.action_alarm_over_jumpbridges.isChecked()
+                            for char, _, distance in self.dotlan.characters_within(system, alarm_distance,
+                                                                                   with_bridges):
+                                chars_by_distance.setdefault(distance, []).append(char)
+                            for distance, chars in chars_by_distance.items():
+                                if message.user not in chars:
                                     self.trayicon.show_notification(message, system.name, ", ".join(chars), distance)
 
-                # self.set_map_content(self.dotlan.svg)
+        if chat_messages:
+            self.add_messages_to_intelchat(chat_messages)
+        # self.set_map_content(self.dotlan.svg)
 
 
 class Bridge(QtCore.QObject):
@@ -764,29 +827,32 @@ class MainWindowPage(QWebEnginePage):
         log.debug('CONSOLE (line {0}): {1}'.format(line_num, message))
 
     @QtCore.pyqtSlot(str, str, name='set_system_status')
-    def set_system_status(self, sys, msg):
+    def set_system_status(self, sys, msg, timestamp=None):
+        """ timestamp = the time (EVE time) of the status, if it is not now"""
         # log.debug('setting system status {0}'.format(sysname))
         if not isinstance(sys, dotlan.System):
             raise Exception('unknown system type')
 
         if isinstance(msg, chatparser.chatparser.Message):
-            str = json.dumps({
+            status = {
                 'type':    'status_change',
                 'sysname' : sys.name,
                 'sysid'   : sys.systemid,
                 'status'  : msg.status
-            })
+            }
         elif isinstance(msg, dict):
-            str = json.dumps({
+            status = {
                 'type':    'status_change',
                 'sysname': sys.name,
                 'sysid': sys.systemid,
                 'status':  msg['status']
-            })
+            }
         else:
             raise Exception('unknown message type')
 
-        self.bridge.to_page(str)
+        if timestamp is not None:
+            status['time'] = calendar.timegm(timestamp.timetuple())
+        self.bridge.to_page(json.dumps(status))
 
     def mark_system(self, sysname):
         self.bridge.to_page(json.dumps({
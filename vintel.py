@@ -19,15 +19,17 @@
 
 # import cStringIO
 import io, os, sys, time, traceback, logging
-import ctypes.wintypes
-from PyQt5 import QtWidgets, QtGui
+import multiprocessing
 from vi import version
-from vi.ui import viui, systemtray
 from vi.cache import cache
+from vi.chatlogs import find_chatlog_dir
 from vi.resources import resource_path
 # from PyQt5 import QtWebEngineWidgets
 
-app = QtWidgets.QApplication(sys.argv)
+# the QApplication is created and the GUI is imported in main(): the
+# processes of the backlog parser run this module too (spawn), they need
+# no Qt
+app = None
 
 error_file = "error.log"
 
@@ -35,6 +37,7 @@ error_file = "error.log"
 def excepthook(excType, excValue, tracebackobj):
     """ Global function to catch unhandled exceptions.
     """
+    from PyQt5 import QtWidgets
     separator = '-' * 80
     notice = \
         """An unhandled exception occurred. Please report the problem\n""" \
@@ -75,47 +78,22 @@ def main():
     FORMAT = '%(asctime)-15s %(filename)s L%(lineno)d %(funcName)s: %(message)s'
     logging.basicConfig(level=logging.FATAL, format=FORMAT, datefmt='%d.%m.%Y %H:%M:%S')
 
-    global error_file
+    global error_file, app
+
+    from PyQt5 import QtWidgets, QtGui
+    from vi.ui import viui, systemtray
+
+    app = QtWidgets.QApplication(sys.argv)
 
     splash = QtWidgets.QSplashScreen(QtGui.QPixmap(resource_path("vi/ui/res/logo.png")))
     splash.show()
     app.processEvents()
 
-    PATH_TO_LOGS = None
-
     # did we have a manuel path to the logs as an argument at start?
-    if len(sys.argv) > 1:
-        PATH_TO_LOGS = sys.argv[1]
-        print("Try to find Logdir @:", PATH_TO_LOGS)
-
-    # Path to Chatlogs on Linux System using wine
-    if not PATH_TO_LOGS or not os.path.exists(PATH_TO_LOGS):
-        print("Going on find logdir...")
-        PATH_TO_LOGS = os.path.join(os.path.expanduser("~"), "EVE", "logs",
-                                    "Chatlogs")
-        print("Try to find Logdir @:", PATH_TO_LOGS)
-    # Path to Chatlogs on MacOS
-    if not os.path.exists(PATH_TO_LOGS):
-        print("No logdir @:", PATH_TO_LOGS)
-        PATH_TO_LOGS = os.path.join(os.path.expanduser("~"), "Library",
-                                    "Application Support", "Eve Online", "p_drive", "User",
-                                    "My Documents", "EVE", "logs", "Chatlogs")
-        print("Try to find Logdir @:", PATH_TO_LOGS)
-
-    # Path to chatlogs on windows
-    if not os.path.exists(PATH_TO_LOGS):
-        print("No logdir @: ", PATH_TO_LOGS)
-        CSIDL_PERSONAL = 5
-        SHGFP_TYPE_CURRENT = 0
-        buf = ctypes.create_unicode_buffer(ctypes.wintypes.MAX_PATH)
-        ctypes.windll.shell32.SHGetFolderPathW(0, CSIDL_PERSONAL, 0,
-                                               SHGFP_TYPE_CURRENT, buf)
-        documents_path = buf.value
-        print("Documents path? :", documents_path)
-        PATH_TO_LOGS = os.path.join(documents_path, "EVE", "logs", "Chatlogs")
+    PATH_TO_LOGS = find_chatlog_dir(sys.argv[1] if len(sys.argv) > 1 else None)
 
     # None of the pathes for logs exists? So we can not work, sorry
-    if not os.path.exists(PATH_TO_LOGS):
+    if PATH_TO_LOGS is None:
         QtWidgets.QMessageBox.critical(
             None,
             "No path to Logs",
@@ -151,4 +129,5 @@ def main():
 
 
 if __name__ == "__main__":
+    multiprocessing.freeze_support()
     main()